@@ -0,0 +1,38 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class AbstractOutboxEntry(models.Model):
+    """
+    An object that must be (re)indexed. The signal handlers write these when
+    OSCAR_ELASTICSEARCH_USE_OUTBOX is enabled, and the search_index_worker
+    management command indexes and removes them.
+    """
+
+    PRODUCT, CATEGORY = "product", "category"
+    PRODUCT_STOCK, PRODUCT_DELETE = "product_stock", "product_delete"
+    OBJECT_TYPE_CHOICES = [
+        (PRODUCT, _("Product")),
+        (CATEGORY, _("Category")),
+        (PRODUCT_STOCK, _("Product stock")),
+        (PRODUCT_DELETE, _("Deleted product")),
+    ]
+
+    object_type = models.CharField(
+        _("Object type"), max_length=32, choices=OBJECT_TYPE_CHOICES
+    )
+    object_id = models.CharField(_("Object id"), max_length=64)
+    attempts = models.PositiveIntegerField(_("Attempts"), default=0)
+    last_error = models.TextField(_("Last error"), blank=True)
+    date_created = models.DateTimeField(_("Date created"), auto_now_add=True)
+
+    class Meta:
+        abstract = True
+        app_label = "search"
+        ordering = ["pk"]
+        indexes = [models.Index(fields=["object_type", "attempts"])]
+        verbose_name = _("Outbox entry")
+        verbose_name_plural = _("Outbox entries")
+
+    def __str__(self):
+        return "%s %s" % (self.object_type, self.object_id)
@@ -42,4 +42,7 @@ class CategoryElasticsearchIndex(BaseElasticSearchApi, ESModelIndexer):
             category_resources
         )
 
-        return dict_codec.dump(category_document_resources, include_type_field=False)
+        return (
+            dict_codec.dump(document, include_type_field=False)
+            for document in category_document_resources
+        )
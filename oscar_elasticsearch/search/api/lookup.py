@@ -1,3 +1,8 @@
+from itertools import groupby
+from operator import itemgetter
+
+from django.db.models import QuerySet
+
 from oscar.core.loading import get_class
 
 BaseElasticSearchApi = get_class("search.api.search", "BaseElasticSearchApi")
@@ -11,7 +16,17 @@ class BaseLookupIndex(BaseElasticSearchApi, ESModelIndexer):
 
     set LOOKUP_PATH as the field you want to save on the lookup index, that you can use to filter stuff on the main index you're using
 
-    Example for make_documents:
+    Set LOOKUP_OWNER_FIELD and LOOKUP_VALUE_FIELD to the fields of Model that
+    hold the id of the document and the values to store in LOOKUP_PATH, and the
+    documents are built with a single query per chunk. For example, to store the
+    products of every user:
+
+    Model = AssortmentUser
+    LOOKUP_PATH = "product_ids"
+    LOOKUP_OWNER_FIELD = "user_id"
+    LOOKUP_VALUE_FIELD = "products__product_id"
+
+    Or implement make_documents yourself:
     def make_documents(self, objects):
         documents = []
 
@@ -29,6 +44,8 @@ class BaseLookupIndex(BaseElasticSearchApi, ESModelIndexer):
     """
 
     LOOKUP_PATH = None
+    LOOKUP_OWNER_FIELD = None
+    LOOKUP_VALUE_FIELD = None
     INDEX_SETTINGS = {}
 
     def get_index_mapping(self):
@@ -37,6 +54,37 @@ class BaseLookupIndex(BaseElasticSearchApi, ESModelIndexer):
 
         return {"properties": {self.LOOKUP_PATH: {"type": "keyword"}}}
 
+    def make_documents(self, objects):
+        if self.LOOKUP_OWNER_FIELD is None or self.LOOKUP_VALUE_FIELD is None:
+            raise NotImplementedError(
+                "Please set LOOKUP_OWNER_FIELD and LOOKUP_VALUE_FIELD, or implement "
+                "'make_documents' on your lookup index"
+            )
+
+        if not isinstance(objects, QuerySet):
+            objects = self.Model.objects.filter(pk__in=[o.pk for o in objects])
+
+        # Ordered by owner, so all values of a document are next to each other.
+        # Objects without values are included with None as value, so their
+        # documents are emptied.
+        rows = (
+            objects.order_by(self.LOOKUP_OWNER_FIELD, self.LOOKUP_VALUE_FIELD)
+            .values_list(self.LOOKUP_OWNER_FIELD, self.LOOKUP_VALUE_FIELD)
+            .iterator()
+        )
+        for owner_id, owner_rows in groupby(rows, key=itemgetter(0)):
+            if owner_id is None:
+                continue
+
+            yield {
+                "_id": owner_id,
+                "_source": {
+                    self.LOOKUP_PATH: [
+                        value for _, value in owner_rows if value is not None
+                    ]
+                },
+            }
+
     def get_lookup_id(self, field_to_filter, **kwargs):
         raise NotImplementedError("""
             Please implement 'get_lookup_id' on your lookup index. 
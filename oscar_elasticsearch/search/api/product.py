@@ -1,14 +1,25 @@
+from contextlib import contextmanager
+from decimal import Decimal
+
 from odin.codecs import dict_codec
 
-from django.db.models import QuerySet, Count, Subquery, OuterRef, IntegerField
+from elasticsearch.helpers import scan
+
+from django.db.models import QuerySet, Count, Subquery, OuterRef, IntegerField, Q
 from django.utils import timezone
+from django.utils.encoding import force_str
 
 from dateutil.relativedelta import relativedelta
 
 from oscar.core.loading import get_class, get_model, get_classes
 from oscar_elasticsearch.search import settings
 
-from oscar_elasticsearch.search.utils import get_category_ancestors
+from oscar_elasticsearch.search.utils import (
+    chunked,
+    get_category_tree_version,
+    bump_category_tree_version,
+    get_category_context,
+)
 
 # this index name is retrived with get_class because of i18n but it might be removed later
 (
@@ -25,13 +36,40 @@ from oscar_elasticsearch.search.utils import get_category_ancestors
         "get_oscar_index_settings",
     ],
 )
+format_price, get_product_priority, get_product_status = get_classes(
+    "search.mappings.products.mappings",
+    ["format_price", "get_product_priority", "get_product_status"],
+)
 BaseElasticSearchApi = get_class("search.api.search", "BaseElasticSearchApi")
+Selector = get_class("partner.strategy", "Selector")
+es = get_class("search.backend", "es")
 ESModelIndexer = get_class("search.indexing.indexer", "ESModelIndexer")
 Product = get_model("catalogue", "Product")
 Category = get_model("catalogue", "Category")
 Line = get_model("order", "Line")
 
 
+# Replaces the category entries of a product document with the entries in
+# params.categories, and removes the entries of the deleted categories.
+UPDATE_CATEGORIES_SCRIPT = """
+List categories = new ArrayList();
+for (def category : ctx._source.categories) {
+    String id = String.valueOf(category.id);
+    if (params.categories.containsKey(id)) {
+        categories.add(params.categories[id]);
+    } else if (!params.deleted_ids.contains(id)) {
+        categories.add(category);
+    }
+}
+ctx._source.categories = categories;
+ctx._source[params.fingerprint_field] = null;
+"""
+
+
+def get_popularity_start():
+    return timezone.now() - relativedelta(months=settings.MONTHS_TO_RUN_ANALYTICS)
+
+
 class ProductElasticsearchIndex(BaseElasticSearchApi, ESModelIndexer):
     Model = Product
     INDEX_NAME = OSCAR_PRODUCTS_INDEX_NAME
@@ -39,6 +77,9 @@ class ProductElasticsearchIndex(BaseElasticSearchApi, ESModelIndexer):
     INDEX_SETTINGS = get_oscar_index_settings()
     SEARCH_FIELDS = OSCAR_PRODUCT_SEARCH_FIELDS
     SUGGESTION_FIELD_NAME = settings.SUGGESTION_FIELD_NAME
+    FINGERPRINT_FIELD = "fingerprint"
+    # date_updated changes on every save, even if nothing that is indexed changed.
+    FINGERPRINT_EXCLUDE_FIELDS = ["date_updated"]
     context = {}
 
     def get_filters(self, filters):
@@ -47,13 +88,97 @@ class ProductElasticsearchIndex(BaseElasticSearchApi, ESModelIndexer):
 
         return [{"term": {"is_public": True}}]
 
+    def update_category_context(self):
+        # Only look the category context up again when the category tree changed
+        version = get_category_tree_version()
+        if self.context.get("category_tree_version") != version:
+            self.context.update(get_category_context(version))
+            self.context["category_tree_version"] = version
+
+    def get_popularity(self):
+        """
+        Returns the popularity of all products that were ordered recently, which
+        is a lot faster than looking it up for every chunk of products.
+        """
+        return dict(
+            Line.objects.filter(order__date_placed__gte=get_popularity_start())
+            .order_by()
+            .values("product")
+            .annotate(count=Count("id"))
+            .values_list("product", "count")
+        )
+
+    @contextmanager
+    def reindex(self, resume=False):
+        # The class level context is shared by all instances, the popularity is
+        # only for the documents of this reindex.
+        self.context = {**self.context, "popularity": self.get_popularity()}
+        try:
+            with super().reindex(resume) as index:
+                yield index
+        finally:
+            self.context.pop("popularity", None)
+
+    def update_popularity(self):
+        """
+        Update the popularity of the indexed products of which the popularity
+        changed, with partial updates.
+        """
+        popularity = {
+            str(product_id): count
+            for product_id, count in self.get_popularity().items()
+        }
+        indexed_popularity = self.indexer.get_all_source_field("popularity")
+
+        num_success, errors = self.indexer.bulk_index(
+            {
+                "_op_type": "update",
+                "_id": product_id,
+                "doc": {
+                    "popularity": popularity.get(product_id),
+                    self.FINGERPRINT_FIELD: None,
+                },
+            }
+            for product_id in set(popularity) | set(indexed_popularity)
+            if popularity.get(product_id) != indexed_popularity.get(product_id)
+        )
+
+        return self.index_missing_products(num_success, errors)
+
     def make_documents(self, objects):
-        if "category_titles" not in self.context:
-            self.context["category_titles"] = dict(
-                Category.objects.values_list("id", "name")
-            )
-        if "category_ancestors" not in self.context:
-            self.context["category_ancestors"] = get_category_ancestors()
+        if settings.FAST_PRODUCT_DOCUMENTS:
+            return self.make_fast_documents(objects)
+
+        return self.dump_documents(
+            self.map_product_resources(self.make_product_resources(objects))
+        )
+
+    def make_fast_documents(self, objects):
+        """
+        Build the documents straight from the product models, see
+        ProductDocumentBuilder.
+        """
+        ProductDocumentBuilder = get_class(
+            "search.mappings.products.documents", "ProductDocumentBuilder"
+        )
+        return ProductDocumentBuilder(self.context).make_documents(
+            self.get_product_queryset(objects)
+        )
+
+    def make_product_resources(self, objects):
+        """
+        Read the products and everything needed to index them from the database,
+        as oscar_odin product resources.
+        """
+        product_queryset_to_resources = get_class(
+            "oscar_odin.mappings.helpers", "product_queryset_to_resources"
+        )
+        return product_queryset_to_resources(
+            self.get_product_queryset(objects), include_children=True
+        )
+
+    def get_product_queryset(self, objects):
+        self.update_category_context()
 
         if not isinstance(objects, QuerySet):
             try:
@@ -65,34 +190,215 @@ class ProductElasticsearchIndex(BaseElasticSearchApi, ESModelIndexer):
                     % type(objects)
                 )
 
-        product_queryset_to_resources = get_class(
-            "oscar_odin.mappings.helpers", "product_queryset_to_resources"
-        )
+        # Annotate the queryset with popularity to avoid the need of n+1 queries,
+        # unless the popularity of all products was already looked up by reindex.
+        if "popularity" not in self.context:
+            objects = objects.annotate(
+                popularity=Subquery(
+                    Line.objects.filter(
+                        product=OuterRef("pk"),
+                        order__date_placed__gte=get_popularity_start(),
+                    )
+                    .values("product")
+                    .annotate(count=Count("id"))
+                    .values("count"),
+                    output_field=IntegerField(),
+                )
+            )
 
+        return objects
+
+    def map_product_resources(self, product_resources):
         ProductElasticSearchMapping = get_class(
             "search.mappings.products", "ProductElasticSearchMapping"
         )
+        return ProductElasticSearchMapping.apply(product_resources, self.context)
 
-        # Annotate the queryset with popularity to avoid the need of n+1 queries
-        objects = objects.annotate(
-            popularity=Subquery(
-                Line.objects.filter(
-                    product=OuterRef("pk"),
-                    order__date_placed__gte=timezone.now()
-                    - relativedelta(months=settings.MONTHS_TO_RUN_ANALYTICS),
-                )
-                .values("product")
-                .annotate(count=Count("id"))
-                .values("count"),
-                output_field=IntegerField(),
+    def dump_documents(self, product_document_resources):
+        # Dump the documents one by one, so they can be streamed to elasticsearch
+        # instead of holding the whole chunk in memory.
+        return (
+            dict_codec.dump(document, include_type_field=False)
+            for document in product_document_resources
+        )
+
+    def make_stock_documents(self, objects):
+        """
+        Build partial documents with only the fields that depend on the stock
+        records, which is a lot cheaper than building the complete documents.
+        """
+        strategy = Selector().strategy()
+        objects = objects.prefetch_related("stockrecords").prefetch_public_children(
+            queryset=Product.objects.public().prefetch_related("stockrecords")
+        )
+
+        for product in objects:
+            if product.is_parent:
+                stock_info = strategy.fetch_for_parent(product)
+            else:
+                stock_info = strategy.fetch_for_product(product)
+
+            price = getattr(stock_info.price, "incl_tax", Decimal(0))
+            is_available = stock_info.availability.is_available_to_buy
+            yield {
+                "_op_type": "update",
+                "_id": product.id,
+                "doc": {
+                    "price": format_price(price),
+                    "currency": getattr(stock_info.price, "currency", ""),
+                    "num_available": getattr(
+                        stock_info.availability, "num_available", 0
+                    ),
+                    "is_available": is_available,
+                    "priority": get_product_priority(product.priority, is_available),
+                    "status": get_product_status(
+                        product.is_public, is_available, product.structure
+                    ),
+                    # The fingerprint no longer matches the document, so the next
+                    # update_or_create must not skip it.
+                    self.FINGERPRINT_FIELD: None,
+                },
+            }
+
+    def update_stock(self, objects):
+        """
+        Update the stock related fields of the indexed products, products that
+        are not indexed yet are indexed completely.
+        """
+        num_success, errors = self.indexer.bulk_index(
+            self.make_stock_documents(objects)
+        )
+        return self.index_missing_products(num_success, errors)
+
+    def index_missing_products(self, num_success, errors):
+        """
+        Index the products of which a partial update failed because they are
+        not in the live index or in an index that is being rebuilt, with their
+        complete documents. Products that no longer exist are left out.
+        """
+        missing_ids = {
+            error["update"]["_id"]
+            for error in errors
+            if error["update"].get("status") == 404
+        }
+        if not missing_ids:
+            return num_success, errors
+
+        num_created, create_errors = self.update_or_create(
+            Product.objects.filter(id__in=missing_ids)
+        )
+        return (
+            num_success + num_created,
+            [error for error in errors if error["update"].get("status") != 404]
+            + create_errors,
+        )
+
+    def update_categories(self, category_ids):
+        """
+        Update the category entries of the indexed products after the categories
+        changed, without building the product documents again. A change also
+        changes the ancestor names of the descendants, so their entries are
+        updated too, and entries of deleted or hidden categories are removed.
+
+        The update is done by elasticsearch in a background task, the task is
+        returned.
+        """
+        if not category_ids:
+            return None
+
+        CategoryToResource = get_class(
+            "oscar_odin.mappings.catalogue", "CategoryToResource"
+        )
+        CategoryRelatedMapping = get_class(
+            "search.mappings.products.mappings", "CategoryRelatedMapping"
+        )
+
+        category_ids = {str(category_id) for category_id in category_ids}
+        categories = Category.objects.filter(id__in=category_ids)
+        descendants = Q()
+        for path in categories.values_list("path", flat=True):
+            descendants |= Q(path__startswith=path)
+        categories = (
+            Category.objects.filter(descendants)
+            if descendants
+            else Category.objects.none()
+        )
+
+        # The signal handlers already bumped the version, but maybe in another
+        # process that doesn't share the cache.
+        bump_category_tree_version()
+        self.update_category_context()
+        # The documents only contain the browsable categories, the entries of
+        # hidden categories are removed like the entries of deleted ones.
+        entries = {
+            str(category.id): dict_codec.dump(
+                CategoryRelatedMapping.apply(category, self.context),
+                include_type_field=False,
             )
+            for category in CategoryToResource.apply(categories.browsable())
+        }
+        deleted_ids = list(
+            (category_ids | {str(pk) for pk in categories.values_list("pk", flat=True)})
+            - set(entries)
         )
 
-        product_resources = product_queryset_to_resources(
-            objects, include_children=True
+        self.index_missing_category_products(list(entries))
+
+        return es.update_by_query(
+            index=",".join(self.indexer.get_write_indices()),
+            ignore_unavailable=True,
+            query={
+                "nested": {
+                    "path": "categories",
+                    "query": {"terms": {"categories.id": list(entries) + deleted_ids}},
+                }
+            },
+            script={
+                "lang": "painless",
+                "source": UPDATE_CATEGORIES_SCRIPT,
+                "params": {
+                    "categories": entries,
+                    "deleted_ids": deleted_ids,
+                    "fingerprint_field": self.FINGERPRINT_FIELD,
+                },
+            },
+            conflicts="proceed",
+            slices="auto",
+            wait_for_completion=False,
         )
-        product_document_resources = ProductElasticSearchMapping.apply(
-            product_resources, self.context
+
+    def index_missing_category_products(self, category_ids):
+        """
+        update_by_query can only update the category entries the documents
+        already have. Products in a category that just became browsable don't
+        have an entry for it yet, so they are indexed again.
+        """
+        if not category_ids:
+            return
+
+        product_ids = set(
+            Product.objects.filter(
+                Q(categories__in=category_ids) | Q(parent__categories__in=category_ids)
+            ).values_list("id", flat=True)
         )
+        indexed_ids = {
+            int(hit["_id"])
+            for hit in scan(
+                es,
+                index=force_str(self.indexer.get_current_alias()),
+                query={
+                    "query": {
+                        "nested": {
+                            "path": "categories",
+                            "query": {"terms": {"categories.id": category_ids}},
+                        }
+                    },
+                    "_source": False,
+                },
+            )
+        }
 
-        return dict_codec.dump(product_document_resources, include_type_field=False)
+        for chunk in chunked(
+            sorted(product_ids - indexed_ids), settings.INDEXING_CHUNK_SIZE
+        ):
+            self.update_or_create(Product.objects.filter(id__in=chunk))
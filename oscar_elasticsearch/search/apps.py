@@ -14,6 +14,7 @@ class OscarElasticSearchConfig(SearchConfig):
     verbose_name = _("Elasticsearch")
 
     namespace = "search"
+    default_auto_field = "django.db.models.BigAutoField"
 
     # pylint: disable=W0201
     def ready(self):
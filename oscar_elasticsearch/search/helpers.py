@@ -1,10 +1,13 @@
-from oscar.core.loading import get_model, get_class
+from django.db.models import Q
+
+from oscar.core.loading import get_model, get_class, get_classes
 
 from oscar_elasticsearch.search import settings
 
-chunked = get_class("search.utils", "chunked")
+chunked, chunked_queryset = get_classes("search.utils", ["chunked", "chunked_queryset"])
 Product = get_model("catalogue", "Product")
 Category = get_model("catalogue", "Category")
+StockRecord = get_model("partner", "StockRecord")
 
 ProductElasticsearchIndex = get_class("search.api.product", "ProductElasticsearchIndex")
 CategoryElasticsearchIndex = get_class(
@@ -13,36 +16,111 @@ CategoryElasticsearchIndex = get_class(
 
 
 def update_index_category(category_id, update_products=True):
-    update_index_categories([category_id])
-
-    if update_products:
-        product_ids = set(
-            Product.objects.filter(categories__id=category_id).values_list(
-                "pk", flat=True
-            )
-        )
-        update_index_products(list(product_ids))
+    return update_index_categories([category_id], update_products)
 
 
 def update_index_categories(category_ids, update_products=True):
+    errors = []
     for chunk in chunked(category_ids, settings.INDEXING_CHUNK_SIZE):
         categories = Category.objects.filter(id__in=chunk)
-        CategoryElasticsearchIndex().update_or_create(categories)
+        _, chunk_errors = CategoryElasticsearchIndex().update_or_create(categories)
+        errors.extend(chunk_errors)
 
+    # The category entries of the products are updated by elasticsearch, the
+    # product documents don't have to be built again.
     if update_products:
-        product_ids = set(
-            Product.objects.filter(categories__id__in=category_ids).values_list(
-                "pk", flat=True
-            )
-        )
-        update_index_products(list(product_ids))
+        ProductElasticsearchIndex().update_categories(category_ids)
+
+    return errors
 
 
 def update_index_product(product_id):
     update_index_products([product_id])
 
 
+def update_index_product_stock(product_ids):
+    errors = []
+    for chunk in chunked(product_ids, settings.INDEXING_CHUNK_SIZE):
+        products = Product.objects.filter(id__in=chunk)
+        _, chunk_errors = ProductElasticsearchIndex().update_stock(products)
+        errors.extend(chunk_errors)
+
+    return errors
+
+
+def delete_products(product_ids):
+    _, errors = ProductElasticsearchIndex().delete_objects(product_ids)
+    return errors
+
+
 def update_index_products(product_ids):
+    errors = []
     for chunk in chunked(product_ids, settings.INDEXING_CHUNK_SIZE):
         products = Product.objects.filter(id__in=chunk)
-        ProductElasticsearchIndex().update_or_create(products)
+        _, chunk_errors = ProductElasticsearchIndex().update_or_create(products)
+        errors.extend(chunk_errors)
+
+    return errors
+
+
+def get_changed_product_ids(since):
+    """
+    Returns the ids of the products that changed since the given moment, either
+    the product itself or one of its stockrecords. Parents of changed child
+    products are included as well, because their documents contain the children.
+    """
+    changed_products = Product.objects.filter(date_updated__gt=since).values("pk")
+    changed_stockrecords = StockRecord.objects.filter(date_updated__gt=since).values(
+        "product_id"
+    )
+
+    product_ids = set(changed_products.values_list("pk", flat=True))
+    product_ids.update(changed_stockrecords.values_list("product_id", flat=True))
+    product_ids.update(
+        Product.objects.filter(
+            Q(pk__in=changed_products) | Q(pk__in=changed_stockrecords),
+            parent__isnull=False,
+        ).values_list("parent_id", flat=True)
+    )
+
+    return product_ids
+
+
+# The popularity of the products per index that is being built, so a worker
+# process only looks it up once instead of for every id range.
+reindex_popularity = {}
+
+
+def get_reindex_popularity(index, alias_name):
+    if alias_name not in reindex_popularity:
+        # A worker process is only used for a single reindex
+        reindex_popularity.clear()
+        reindex_popularity[alias_name] = index.get_popularity()
+
+    return reindex_popularity[alias_name]
+
+
+def reindex_product_range(alias_name, start_id, end_id):
+    """
+    Index all products with an id between start_id and end_id (inclusive) into
+    the index alias_name. This is the unit of work of the parallel reindex in
+    update_index_products, so it must be importable from a worker process.
+    Returns the errors of the documents that could not be indexed.
+    """
+    index = ProductElasticsearchIndex()
+    index.indexer.alias_name = alias_name
+
+    products = index.exclude_completed(
+        Product.objects.filter(pk__gte=start_id, pk__lte=end_id)
+    )
+    index.context = {
+        **index.context,
+        "popularity": get_reindex_popularity(index, alias_name),
+    }
+
+    errors = []
+    for chunk in chunked_queryset(products, settings.INDEXING_CHUNK_SIZE):
+        _, chunk_errors = index.reindex_objects(chunk)
+        errors.extend(chunk_errors)
+
+    return errors
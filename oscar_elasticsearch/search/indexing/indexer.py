@@ -1,20 +1,122 @@
+import re
+import time
 from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
 
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.crypto import get_random_string
+from django.utils.dateparse import parse_datetime
 from django.utils.text import format_lazy
 from django.utils.encoding import force_str
 
 from oscar.core.loading import get_class
 
-from elasticsearch.helpers import bulk
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import streaming_bulk, parallel_bulk, scan
+from elasticsearch.exceptions import ApiError, NotFoundError
 
+from oscar_elasticsearch.search import settings as search_settings
 from oscar_elasticsearch.search.api.base import BaseModelIndex
+from oscar_elasticsearch.search.utils import (
+    AdaptiveChunkSize,
+    get_document_fingerprint,
+    merge_ranges,
+)
 
 es = get_class("search.backend", "es")
 
+# The indices the aliases point to, shared by all indexers in the process
+# {alias_name: (expires, [index_name, ...])}
+alias_cache = {}
+
+
+def get_alias_indices(name):
+    """
+    Returns the names of the indices the alias points to. They are cached for
+    OSCAR_ELASTICSEARCH_ALIAS_CACHE_TIMEOUT seconds, so writes don't need an
+    extra request to look them up.
+    """
+    cached = alias_cache.get(name)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    try:
+        indices = list(es.indices.get_alias(name=name, ignore_unavailable=True).keys())
+    except NotFoundError:
+        indices = []
+
+    alias_cache[name] = (
+        time.monotonic() + search_settings.ALIAS_CACHE_TIMEOUT,
+        indices,
+    )
+    return indices
+
+
+def invalidate_alias_cache(*names):
+    for name in names:
+        alias_cache.pop(name, None)
+
+
+def add_index(documents, _index):
+    for doc in documents:
+        doc["_index"] = _index
+        yield doc
+
+
+def add_indices(documents, indices):
+    for doc in documents:
+        for _index in indices:
+            yield {**doc, "_index": _index}
+
+
+def as_create(documents):
+    for doc in documents:
+        doc["_op_type"] = "create"
+        yield doc
+
+
+# Index settings that can only be set when an index is created, changing them
+# requires building a new index.
+STATIC_INDEX_SETTINGS = [
+    "analysis",
+    "codec",
+    "number_of_routing_shards",
+    "number_of_shards",
+    "routing_partition_size",
+    "similarity",
+    "sort",
+]
+
+
+def get_checkpoint_at(index):
+    """
+    Returns when the indexing of one of the indices returned by
+    get_built_indices last made progress, or when it was created if that is
+    not known.
+    """
+    checkpoint_at = index["meta"].get("checkpoint_at")
+    if checkpoint_at is not None:
+        return parse_datetime(checkpoint_at)
+
+    return datetime.fromtimestamp(index["creation_date"] / 1000, tz=dt_timezone.utc)
+
+
+def get_error_status(error):
+    (item,) = error.values()
+    return item.get("status")
+
+
+def get_error_type(error):
+    (item,) = error.values()
+    return (item.get("error") or {}).get("type")
+
 
 class Indexer(object):
+    DEFINITION_UNCHANGED = "unchanged"
+    DEFINITION_SETTINGS_CHANGED = "settings_changed"
+    DEFINITION_CHANGED = "changed"
+
     def __init__(self, name, mappings, settings):
         self.name = name
         self.alias_name = format_lazy(
@@ -22,39 +124,575 @@ class Indexer(object):
         )
         self.mappings = mappings
         self.settings = settings
+        self.bulk_chunk_size = AdaptiveChunkSize(
+            search_settings.INDEXING_BULK_CHUNK_SIZE,
+            search_settings.INDEXING_BULK_MIN_CHUNK_SIZE,
+            search_settings.INDEXING_BULK_MAX_CHUNK_SIZE,
+            search_settings.INDEXING_BULK_TARGET_SECONDS,
+        )
+        # When this process last recorded the progress of the rebuild
+        self.checkpoint_time = None
+        # Completed ranges that are not in the index mapping yet
+        self.unsaved_ranges = []
+
+    def copy(self):
+        """
+        Returns an indexer that writes into the same index, with its own chunk
+        size and progress, so it can be used in another thread.
+        """
+        indexer = type(self)(self.name, self.mappings, self.settings)
+        indexer.alias_name = self.alias_name
+        return indexer
+
+    @property
+    def rebuild_alias_name(self):
+        # Points to the indices that are being built, so updates can be written
+        # to them as well, see get_write_indices.
+        return "%s__rebuilding" % self.name
 
     def execute(self, documents):
-        self.bulk_index(documents, self.alias_name)
+        # Updates written to the new index while it is being built are newer than
+        # the documents of the rebuild, which must not overwrite them.
+        num_success, errors = self.bulk_index(as_create(documents), self.alias_name)
+
+        # Chunks can be indexed without recording completed ranges, the index
+        # must not be mistaken for an abandoned one in the meantime.
+        if (
+            self.checkpoint_time is None
+            or time.monotonic() - self.checkpoint_time
+            > search_settings.INDEXING_STALE_TIMEOUT / 10
+        ):
+            self.update_meta({}, self.alias_name)
+
+        return num_success, [
+            error for error in errors if get_error_status(error) != 409
+        ]
 
     def start(self):
+        # Everything that changes after this moment might be missing from the new
+        # index, so incremental updates must start from here.
+        indexed_until = timezone.now()
+
         # Create alias
-        self.create(self.alias_name)
+        if search_settings.INDEXING_BULK_LOAD:
+            self.create(self.alias_name, self.get_bulk_load_settings())
+        else:
+            self.create(self.alias_name)
+
+        # The completed ranges are the checkpoint that allows resuming, they are
+        # removed when the index is finished.
+        self.update_meta(
+            {
+                "indexed_until": indexed_until.isoformat(),
+                "completed_ranges": [],
+                "definition": self.get_definition_fingerprint(),
+            },
+            self.alias_name,
+        )
+        es.indices.put_alias(index=self.alias_name, name=self.rebuild_alias_name)
+        invalidate_alias_cache(self.rebuild_alias_name)
+
+    def resume(self):
+        """
+        Continue building the newest index that was never finished, instead of
+        creating a new one. Returns False when there is no such index, or when it
+        was created with another mapping or other settings.
+
+        Indices that made progress within INDEXING_STALE_TIMEOUT might still be
+        built by another process, so they are not resumed.
+        """
+        stale_before = timezone.now() - timedelta(
+            seconds=search_settings.INDEXING_STALE_TIMEOUT
+        )
+        unfinished_indices = [
+            index
+            for index in self.get_built_indices()
+            if self.name not in index["aliases"]
+            and index["meta"].get("completed_ranges") is not None
+            and get_checkpoint_at(index) <= stale_before
+        ]
+        if not unfinished_indices:
+            return False
+
+        index = unfinished_indices[-1]
+        if index["meta"].get("definition") != self.get_definition_fingerprint():
+            return False
+
+        self.alias_name = index["name"]
+        self.update_meta({}, self.alias_name)
+        es.indices.put_alias(index=self.alias_name, name=self.rebuild_alias_name)
+        invalidate_alias_cache(self.rebuild_alias_name)
+        return True
+
+    def get_built_indices(self):
+        """
+        Returns the indices that were created for this index by start, ordered
+        by creation date.
+        """
+        pattern = re.compile(r"^%s_[a-z0-9]{7}$" % re.escape(self.name))
+        indices = es.indices.get(index="%s_*" % self.name, ignore_unavailable=True)
+        return sorted(
+            (
+                {
+                    "name": name,
+                    "aliases": list(index.get("aliases", {})),
+                    "meta": index.get("mappings", {}).get("_meta", {}),
+                    "creation_date": int(
+                        index.get("settings", {})
+                        .get("index", {})
+                        .get("creation_date", 0)
+                    ),
+                }
+                for name, index in indices.items()
+                if pattern.match(name)
+            ),
+            key=lambda index: index["creation_date"],
+        )
+
+    def get_completed_ranges(self):
+        return merge_ranges(
+            (self.get_meta(self.alias_name).get("completed_ranges") or [])
+            + self.unsaved_ranges
+        )
+
+    def add_completed_range(self, start_id, end_id):
+        """
+        Record that all objects with an id from start_id to end_id (inclusive) are
+        in the index, so they are skipped when the indexing is resumed.
+
+        Every update of the mapping is a cluster state update, so the ranges are
+        saved at most once every INDEXING_CHECKPOINT_INTERVAL seconds.
+        """
+        self.unsaved_ranges.append([start_id, end_id])
+        if (
+            self.checkpoint_time is None
+            or time.monotonic() - self.checkpoint_time
+            >= search_settings.INDEXING_CHECKPOINT_INTERVAL
+        ):
+            self.save_completed_ranges()
+
+    def save_completed_ranges(self):
+        """
+        Write the ranges recorded by add_completed_range that were not saved yet.
+        """
+        if self.unsaved_ranges:
+            self.update_meta(
+                {"completed_ranges": self.get_completed_ranges()}, self.alias_name
+            )
+            self.unsaved_ranges = []
+
+    def get_bulk_load_settings(self):
+        """
+        The index settings used while the index is being built. Refreshes and
+        replicas are disabled, because nobody searches the index before the alias
+        is switched to it in finish.
+        """
+        bulk_load_settings = {"refresh_interval": "-1", "number_of_replicas": 0}
+        if search_settings.INDEXING_BULK_LOAD_ASYNC_TRANSLOG:
+            bulk_load_settings["translog.durability"] = "async"
+
+        settings = {
+            key: value
+            for key, value in (self.settings or {}).items()
+            if key.replace("index.", "", 1) not in bulk_load_settings
+        }
+        settings["index"] = {
+            key: value
+            for key, value in settings.get("index", {}).items()
+            if key not in bulk_load_settings
+        }
+        settings["index"].update(bulk_load_settings)
+
+        return settings
+
+    def get_flat_settings(self):
+        """
+        Returns the configured index settings without the "index." prefix, so
+        they can be compared regardless of how they are nested.
+        """
+        settings = {
+            key.replace("index.", "", 1): value
+            for key, value in (self.settings or {}).items()
+            if key != "index"
+        }
+        settings.update((self.settings or {}).get("index", {}))
+        return settings
+
+    def get_dynamic_settings(self):
+        """
+        Returns the configured index settings that can be changed on an existing
+        index.
+        """
+        return {
+            key: value
+            for key, value in self.get_flat_settings().items()
+            if key.split(".")[0] not in STATIC_INDEX_SETTINGS
+        }
+
+    def get_definition_fingerprint(self):
+        """
+        Returns hashes of the mappings and settings the index is built with, they
+        are stored in the _meta of the index to know if it must be rebuilt.
+        """
+        dynamic_settings = self.get_dynamic_settings()
+        return {
+            "mappings": get_document_fingerprint(self.mappings or {}),
+            "settings": get_document_fingerprint(
+                self.get_flat_settings(), exclude=dynamic_settings
+            ),
+            "dynamic_settings": get_document_fingerprint(dynamic_settings),
+        }
+
+    def get_definition_changes(self):
+        """
+        Compare the mappings and settings of the live index with the configured
+        ones. Returns DEFINITION_CHANGED when the index must be rebuilt,
+        DEFINITION_SETTINGS_CHANGED when only settings that can be updated in
+        place changed and DEFINITION_UNCHANGED otherwise.
+        """
+        indexed = self.get_meta().get("definition")
+        if not indexed:
+            return self.DEFINITION_CHANGED
+
+        current = self.get_definition_fingerprint()
+        if (
+            indexed.get("mappings") != current["mappings"]
+            or indexed.get("settings") != current["settings"]
+        ):
+            return self.DEFINITION_CHANGED
+        if indexed.get("dynamic_settings") != current["dynamic_settings"]:
+            return self.DEFINITION_SETTINGS_CHANGED
+
+        return self.DEFINITION_UNCHANGED
+
+    def update_dynamic_settings(self):
+        current_alias = force_str(self.get_current_alias())
+        es.indices.put_settings(
+            index=current_alias, settings={"index": self.get_dynamic_settings()}
+        )
+        self.update_meta(
+            {"definition": self.get_definition_fingerprint()}, current_alias
+        )
+
+    def get_configured_setting(self, name):
+        settings = self.settings or {}
+        for key in [name, "index.%s" % name]:
+            if key in settings:
+                return settings[key]
+
+        return settings.get("index", {}).get(name)
+
+    def restore_settings(self):
+        """
+        Restore the settings that were relaxed by get_bulk_load_settings to their
+        configured values, settings that were not configured are reset to the
+        elasticsearch defaults.
+        """
+        es.indices.put_settings(
+            index=self.alias_name,
+            settings={
+                "index": {
+                    name: self.get_configured_setting(name)
+                    for name in [
+                        "refresh_interval",
+                        "number_of_replicas",
+                        "translog.durability",
+                    ]
+                }
+            },
+        )
 
     def index(self, _id, document, current_alias=None):
+        if current_alias is None:
+            indices = self.get_write_indices()
+        else:
+            indices = [force_str(current_alias)]
+
+        require_alias = indices[0] == self.name
+        for _index in indices:
+            es.index(
+                index=_index,
+                id=_id,
+                document=document,
+                require_alias=require_alias,
+                # The rebuild alias is gone when the rebuild finished in the
+                # meantime, the live alias points to that index now.
+                ignore=[400, 404] if _index == self.rebuild_alias_name else [400],
+            )
+
+    def bulk_index(self, documents, current_alias=None):
+        """
+        Index the documents in current_alias, or in the live index and the indices
+        that are being rebuilt when it is not given.
+        """
+        if current_alias is not None:
+            return self.bulk(add_index(documents, force_str(current_alias)))
+
+        indices = self.get_write_indices()
+        require_alias = indices[0] == self.name
+        if len(indices) == 1:
+            return self.bulk(
+                add_index(documents, indices[0]), require_alias=require_alias
+            )
+
+        num_success, errors = self.bulk(
+            add_indices(documents, indices), require_alias=require_alias
+        )
+
+        # The rebuild alias is gone when the rebuild finished in the meantime,
+        # the live alias points to that index now.
+        alias_gone = [
+            error
+            for error in errors
+            if get_error_type(error) == "index_not_found_exception"
+            and list(error.values())[0].get("_index") == self.rebuild_alias_name
+        ]
+        if alias_gone:
+            invalidate_alias_cache(self.name, self.rebuild_alias_name)
+
+        # Deletes of documents that were not added to the rebuilt index yet are
+        # not needed. Partial updates of them are returned as errors, the rebuild
+        # might have read the document before the change, so the caller has to
+        # send the complete document.
+        rebuilding_indices = {self.rebuild_alias_name} | (
+            set(get_alias_indices(self.rebuild_alias_name))
+            - set(get_alias_indices(self.name))
+        )
+        return num_success, [
+            error
+            for error in errors
+            if error not in alias_gone
+            and not (
+                "delete" in error
+                and get_error_status(error) == 404
+                and error["delete"].get("_index") in rebuilding_indices
+            )
+        ]
+
+    def get_write_indices(self):
+        """
+        Returns the live alias followed by the alias of the indices that are
+        being rebuilt. Changes must be written to all of them, otherwise they
+        are lost when the alias is switched to the rebuilt index.
+
+        The aliases are written to instead of the cached names of the indices,
+        writing to an index that was deleted in the meantime would create it
+        again. Only when nothing was built yet the new index is returned.
+        """
+        live_indices = get_alias_indices(self.name)
+        if not live_indices:
+            return [force_str(self.get_current_alias())]
+
+        if set(get_alias_indices(self.rebuild_alias_name)) - set(live_indices):
+            return [self.name, self.rebuild_alias_name]
+
+        return [self.name]
+
+    def bulk(self, actions, require_alias=False):
+        """
+        Stream the actions to elasticsearch. The actions are consumed lazily and
+        sent in requests of at most INDEXING_BULK_MAX_BYTES bytes. The number of
+        documents per request adapts to how long the requests take, see
+        AdaptiveChunkSize. Returns the number of successful actions and a list
+        with the errors of the actions that failed. With require_alias the
+        actions fail instead of creating the index when it is not an alias.
+        """
+        thread_count = search_settings.INDEXING_BULK_THREAD_COUNT
+        actions = iter(actions)
+
+        num_success = 0
+        errors = []
+        while True:
+            # With multiple threads every thread sends a request of this size.
+            chunk_size = self.bulk_chunk_size.size
+            batch = list(islice(actions, chunk_size * thread_count))
+            if not batch:
+                break
+
+            started = time.monotonic()
+            batch_success, batch_errors, rejected = self.bulk_batch(
+                batch, chunk_size, require_alias
+            )
+            self.bulk_chunk_size.update(
+                len(batch) // thread_count, time.monotonic() - started, rejected
+            )
+
+            num_success += batch_success
+            errors.extend(batch_errors)
+
+        return num_success, errors
+
+    def bulk_batch(self, actions, chunk_size, require_alias=False):
+        """
+        Send the actions in requests of chunk_size documents. Actions that are
+        rejected because elasticsearch is too busy (429), one by one or with the
+        whole request, are retried with an exponential backoff, up to
+        INDEXING_BULK_MAX_RETRIES times. Returns the
+        number of successful actions, the errors and if any action was rejected.
+        """
+        num_success = 0
+        errors = []
+        rejected = False
+        for attempt in range(search_settings.INDEXING_BULK_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(
+                    search_settings.INDEXING_BULK_INITIAL_BACKOFF * 2 ** (attempt - 1)
+                )
+
+            if search_settings.INDEXING_BULK_THREAD_COUNT > 1:
+                results = parallel_bulk(
+                    es,
+                    actions,
+                    thread_count=search_settings.INDEXING_BULK_THREAD_COUNT,
+                    chunk_size=chunk_size,
+                    max_chunk_bytes=search_settings.INDEXING_BULK_MAX_BYTES,
+                    raise_on_error=False,
+                    require_alias=require_alias,
+                )
+            else:
+                results = streaming_bulk(
+                    es,
+                    actions,
+                    chunk_size=chunk_size,
+                    max_chunk_bytes=search_settings.INDEXING_BULK_MAX_BYTES,
+                    raise_on_error=False,
+                    require_alias=require_alias,
+                )
+
+            # Both helpers return the results in the order of the actions.
+            retry = []
+            num_done = 0
+            try:
+                for action, (ok, item) in zip(actions, results):
+                    num_done += 1
+                    if ok:
+                        num_success += 1
+                    elif (
+                        get_error_status(item) == 429
+                        and attempt < search_settings.INDEXING_BULK_MAX_RETRIES
+                    ):
+                        retry.append(action)
+                    else:
+                        errors.append(item)
+            except ApiError as e:
+                # The whole request was rejected, the actions of the requests
+                # that were not answered yet are sent again.
+                if (
+                    e.status_code != 429
+                    or attempt == search_settings.INDEXING_BULK_MAX_RETRIES
+                ):
+                    raise
+                retry.extend(actions[num_done:])
+
+            if not retry:
+                break
+
+            rejected = True
+            actions = retry
+
+        return num_success, errors, rejected
+
+    def bulk_delete(self, ids, current_alias=None):
+        """
+        Delete the documents with the given ids in bulk. Documents that were not
+        indexed are not reported as errors.
+        """
+        if not ids:
+            return 0, []
+
+        num_success, errors = self.bulk_index(
+            ({"_op_type": "delete", "_id": _id} for _id in ids), current_alias
+        )
+        return num_success, [
+            error for error in errors if get_error_status(error) != 404
+        ]
+
+    def get_source_field(self, ids, field, current_alias=None):
+        """
+        Returns a dict with the value of a single field of the indexed documents
+        with the given ids, documents that are not indexed are left out.
+        """
+        if not ids:
+            return {}
+
         if current_alias is None:
             current_alias = self.get_current_alias()
 
-        _index = force_str(current_alias)
+        response = es.mget(
+            index=force_str(current_alias), ids=ids, source_includes=[field]
+        )
+        return {
+            doc["_id"]: doc["_source"].get(field)
+            for doc in response["docs"]
+            if doc.get("found")
+        }
+
+    def get_all_source_field(self, field, current_alias=None):
+        """
+        Returns a dict with the value of a single field of all indexed documents
+        that have a value for it.
+        """
+        if current_alias is None:
+            current_alias = self.get_current_alias()
 
-        es.index(index=_index, id=_id, document=document, ignore=[400])
+        return {
+            hit["_id"]: hit["_source"][field]
+            for hit in scan(
+                es,
+                index=force_str(current_alias),
+                query={"query": {"exists": {"field": field}}, "_source": [field]},
+            )
+        }
 
-    def bulk_index(self, documents, current_alias=None):
+    def get_all_ids(self, current_alias=None):
+        """
+        Returns the ids of all indexed documents.
+        """
         if current_alias is None:
             current_alias = self.get_current_alias()
 
-        _index = force_str(current_alias)
+        return {
+            hit["_id"]
+            for hit in scan(
+                es,
+                index=force_str(current_alias),
+                query={"query": {"match_all": {}}, "_source": False},
+            )
+        }
 
-        docs = []
-        for doc in documents:
-            doc["_index"] = _index
-            docs.append(doc)
+    def get_meta(self, current_alias=None):
+        """
+        Returns the _meta of the index mapping, which is used to store information
+        about the indexing process, like up to when the index is up to date.
+        """
+        if current_alias is None:
+            current_alias = self.get_current_alias()
 
-        bulk(es, docs, ignore=[400])
+        try:
+            mappings = es.indices.get_mapping(index=force_str(current_alias))
+        except NotFoundError:
+            return {}
+
+        for index_mappings in mappings.values():
+            return index_mappings["mappings"].get("_meta", {})
+
+        return {}
+
+    def update_meta(self, meta, current_alias=None):
+        if current_alias is None:
+            current_alias = self.get_current_alias()
+
+        meta = {**self.get_meta(current_alias), **meta}
+        # Every update of an index that is being built is a sign of progress,
+        # see delete_stale_indices.
+        if meta.get("completed_ranges") is not None:
+            meta["checkpoint_at"] = timezone.now().isoformat()
+            self.checkpoint_time = time.monotonic()
+
+        es.indices.put_mapping(index=force_str(current_alias), meta=meta)
 
     def get_current_alias(self):
-        aliasses = list(
-            es.indices.get_alias(name=self.name, ignore_unavailable=True).keys()
-        )
+        aliasses = get_alias_indices(self.name)
         if aliasses:
             return aliasses[0]
 
@@ -63,6 +701,27 @@ class Indexer(object):
     def finish(self):
         es.indices.refresh(index=self.alias_name)
 
+        # Merging before the replicas are restored means the segments only have
+        # to be merged once, the replicas copy the merged segments.
+        if search_settings.INDEXING_FORCE_MERGE_SEGMENTS:
+            es.options(request_timeout=None).indices.forcemerge(
+                index=self.alias_name,
+                max_num_segments=search_settings.INDEXING_FORCE_MERGE_SEGMENTS,
+            )
+
+        if search_settings.INDEXING_BULK_LOAD:
+            self.restore_settings()
+
+        if search_settings.INDEXING_WAIT_FOR_STATUS:
+            es.options(request_timeout=None).cluster.health(
+                index=self.alias_name,
+                wait_for_status=search_settings.INDEXING_WAIT_FOR_STATUS,
+                timeout=search_settings.INDEXING_WAIT_FOR_STATUS_TIMEOUT,
+            )
+
+        self.unsaved_ranges = []
+        self.update_meta({"completed_ranges": None}, self.alias_name)
+
         # Check if alias exists for indice
         if es.indices.exists_alias(name=self.name):
             # Get alisases
@@ -72,6 +731,7 @@ class Indexer(object):
 
             # Link the new alias to the old indice
             es.indices.put_alias(name=self.name, index=self.alias_name)
+            self.delete_rebuild_alias()
 
             # Cleanup old aliased
             for index in aliased_indices:
@@ -82,10 +742,43 @@ class Indexer(object):
 
             # No indices yet, make alias from original name to alias name
             es.indices.put_alias(name=self.name, index=self.alias_name)
+            self.delete_rebuild_alias()
 
-    def create(self, name):
+        invalidate_alias_cache(self.name, self.rebuild_alias_name)
+        self.delete_stale_indices()
+
+    def delete_rebuild_alias(self):
+        # Only after the alias is switched, so no update can get lost in between.
+        try:
+            es.indices.delete_alias(index=self.alias_name, name=self.rebuild_alias_name)
+        except NotFoundError:
+            pass
+
+    def delete_stale_indices(self):
+        """
+        Delete the indices that were never finished, because the indexing failed
+        or was aborted. Indices that made progress in the last
+        INDEXING_STALE_TIMEOUT seconds are kept, another reindex could still be
+        building them.
+        """
+        stale_before = timezone.now() - timedelta(
+            seconds=search_settings.INDEXING_STALE_TIMEOUT
+        )
+        for index in self.get_built_indices():
+            if index["name"] == force_str(self.alias_name):
+                continue
+            if self.name in index["aliases"]:
+                continue
+            if get_checkpoint_at(index) < stale_before:
+                self.delete(index["name"])
+
+    def create(self, name, settings=None):
         return es.indices.create(
-            index=name, body={"settings": self.settings, "mappings": self.mappings}
+            index=name,
+            body={
+                "settings": self.settings if settings is None else settings,
+                "mappings": self.mappings,
+            },
         )
 
     def delete(self, name):
@@ -102,12 +795,33 @@ class Indexer(object):
 
 
 class ESModelIndexer(BaseModelIndex):
+    # Set FINGERPRINT_FIELD to store a hash of every document in that field, so
+    # update_or_create can skip the documents that did not change.
+    FINGERPRINT_FIELD = None
+    # Fields that are left out of the fingerprint, for example timestamps that
+    # change without the rest of the document changing.
+    FINGERPRINT_EXCLUDE_FIELDS = []
+    # Number of objects per chunk when update_index_registered rebuilds the
+    # index, OSCAR_ELASTICSEARCH_INDEXING_CHUNK_SIZE when None.
+    INDEXING_CHUNK_SIZE = None
+    # Number of chunks update_index_registered indexes at the same time.
+    INDEXING_WORKERS = 1
+    # Registered indexes that update_index_registered must rebuild before this
+    # one, the others may be rebuilt at the same time.
+    INDEXING_DEPENDENCIES = []
+
     def __init__(self):
         super().__init__()
         self.indexer = Indexer(
             self.get_index_name(), self.get_index_mapping(), self.get_index_settings()
         )
 
+    def get_indexing_chunk_size(self):
+        if self.INDEXING_CHUNK_SIZE is None:
+            return search_settings.INDEXING_CHUNK_SIZE
+
+        return self.INDEXING_CHUNK_SIZE
+
     def make_documents(self, objects):
         raise NotImplementedError(
             "Please implement `make_documents` on your indexer class"
@@ -115,27 +829,94 @@ class ESModelIndexer(BaseModelIndex):
 
     def update_or_create(self, objects):
         es_data = self.make_documents(objects)
+        if self.FINGERPRINT_FIELD is not None:
+            es_data = self.skip_unchanged(self.add_fingerprints(es_data))
         return self.indexer.bulk_index(es_data)
 
+    def add_fingerprints(self, documents):
+        exclude = [self.FINGERPRINT_FIELD] + self.FINGERPRINT_EXCLUDE_FIELDS
+        for document in documents:
+            source = document["_source"]
+            source[self.FINGERPRINT_FIELD] = get_document_fingerprint(source, exclude)
+            yield document
+
+    def skip_unchanged(self, documents):
+        """
+        Leave out the documents of which the fingerprint is equal to the
+        fingerprint of the indexed document.
+        """
+        documents = list(documents)
+        indexed_fingerprints = self.indexer.get_source_field(
+            [document["_id"] for document in documents], self.FINGERPRINT_FIELD
+        )
+        return [
+            document
+            for document in documents
+            if indexed_fingerprints.get(str(document["_id"]))
+            != document["_source"][self.FINGERPRINT_FIELD]
+        ]
+
     def index(self, obj):
         (es_data,) = self.make_documents([obj])
         self.indexer.index(obj.id, es_data["_source"])
 
     @contextmanager
-    def reindex(self):
+    def reindex(self, resume=False):
         """
         Example usage:
         with CategoryElasticsearchIndex().reindex() as index:
-            for chunk in chunked(categories, settings.INDEXING_CHUNK_SIZE):
+            for chunk in chunked_queryset(categories, settings.INDEXING_CHUNK_SIZE):
                 index.reindex_objects(chunk)
+
+        With resume the newest unfinished index is used if there is one, use
+        index.indexer.get_completed_ranges to skip what was already indexed.
         """
-        self.indexer.start()
-        yield self
+        if not (resume and self.indexer.resume()):
+            self.indexer.start()
+        try:
+            yield self
+        except BaseException:
+            # Keep the progress that was made, so a resume can skip it
+            self.indexer.save_completed_ranges()
+            raise
         self.indexer.finish()
 
     def reindex_objects(self, objects):
         es_data = self.make_documents(objects)
+        if self.FINGERPRINT_FIELD is not None:
+            es_data = self.add_fingerprints(es_data)
         return self.indexer.execute(es_data)
 
+    def exclude_completed(self, queryset):
+        """
+        Leave out the objects that were already indexed before the reindex was
+        resumed.
+        """
+        completed = Q()
+        for start_id, end_id in self.indexer.get_completed_ranges():
+            completed |= Q(pk__gte=start_id, pk__lte=end_id)
+
+        if completed:
+            return queryset.exclude(completed)
+
+        return queryset
+
     def delete(self, _id):
         return self.indexer.delete_doc(_id)
+
+    def delete_objects(self, ids):
+        return self.indexer.bulk_delete(ids)
+
+    def get_indexed_until(self):
+        """
+        Returns the moment up to which all changes are in the index, None if
+        this is not known.
+        """
+        indexed_until = self.indexer.get_meta().get("indexed_until")
+        if indexed_until is not None:
+            return parse_datetime(indexed_until)
+
+        return None
+
+    def set_indexed_until(self, indexed_until):
+        self.indexer.update_meta({"indexed_until": indexed_until.isoformat()})
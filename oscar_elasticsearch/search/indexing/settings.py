@@ -91,6 +91,7 @@ def get_products_index_mapping():
             "string_attrs": {"type": "text", "copy_to": "_all_text"},
             "popularity": {"type": "integer"},
             "has_image": {"type": "boolean"},
+            "fingerprint": {"type": "keyword", "index": False},
             "status": {"type": "text"},
             "categories": {
                 "type": "nested",
@@ -0,0 +1,76 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from oscar.core.loading import get_classes
+
+from oscar_elasticsearch.search import settings
+
+process_outbox, get_outbox_depth = get_classes(
+    "search.outbox", ["process_outbox", "get_outbox_depth"]
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Index the products and categories in the outbox, which is filled by the "
+        "signal handlers when OSCAR_ELASTICSEARCH_USE_OUTBOX is enabled."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.INDEXING_CHUNK_SIZE,
+            help="Number of outbox entries of every type to index at once",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=settings.OUTBOX_MAX_ATTEMPTS,
+            help="Number of times an entry is tried before it is left alone",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1,
+            help="Seconds to wait when the outbox is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Stop when the outbox is empty",
+        )
+        parser.add_argument(
+            "--status",
+            action="store_true",
+            help="Only show the number of pending and failed entries",
+        )
+
+    def handle(self, *args, **options):
+        if options["status"]:
+            return self.write_depth(options["max_attempts"])
+
+        while True:
+            close_old_connections()
+            num_processed = process_outbox(
+                options["batch_size"], options["max_attempts"]
+            )
+            if num_processed:
+                self.stdout.write("%i outbox entries processed" % num_processed)
+            elif options["once"]:
+                break
+            else:
+                time.sleep(options["interval"])
+
+        self.write_depth(options["max_attempts"])
+
+    def write_depth(self, max_attempts):
+        depth = get_outbox_depth(max_attempts)
+        if not depth:
+            self.stdout.write(self.style.SUCCESS("The outbox is empty"))
+        for object_type, (pending, failed) in sorted(depth.items()):
+            self.stdout.write(
+                "%s: %i pending, %i failed" % (object_type, pending, failed)
+            )
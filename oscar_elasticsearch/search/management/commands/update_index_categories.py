@@ -4,7 +4,7 @@ from oscar.core.loading import get_class, get_model
 
 from oscar_elasticsearch.search import settings
 
-chunked = get_class("search.utils", "chunked")
+chunked_queryset = get_class("search.utils", "chunked_queryset")
 CategoryElasticsearchIndex = get_class(
     "search.api.category", "CategoryElasticsearchIndex"
 )
@@ -13,17 +13,68 @@ Category = get_model("catalogue", "Category")
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--if-changed",
+            action="store_true",
+            help="Only rebuild the index when its mappings or settings changed, "
+            "otherwise update the categories in the live index",
+        )
+
     def handle(self, *args, **options):
         categories = Category.objects.all()
 
-        with CategoryElasticsearchIndex().reindex() as index:
-            for chunk in chunked(categories, settings.INDEXING_CHUNK_SIZE):
-                index.reindex_objects(chunk)
+        errors = []
+
+        if options["if_changed"] and self.can_update_in_place():
+            index = CategoryElasticsearchIndex()
+            for chunk in chunked_queryset(categories, settings.INDEXING_CHUNK_SIZE):
+                _, chunk_errors = index.update_or_create(chunk)
+                errors.extend(chunk_errors)
                 self.stdout.write(".", ending="")
                 self.stdout.flush()  # Ensure the dots are displayed immediately
 
+            # A rebuild would leave out the categories that were deleted
+            deleted_ids = index.indexer.get_all_ids() - {
+                str(pk) for pk in categories.values_list("pk", flat=True)
+            }
+            if deleted_ids:
+                _, delete_errors = index.delete_objects(sorted(deleted_ids))
+                errors.extend(delete_errors)
+        else:
+            with CategoryElasticsearchIndex().reindex() as index:
+                for chunk in chunked_queryset(categories, settings.INDEXING_CHUNK_SIZE):
+                    _, chunk_errors = index.reindex_objects(chunk)
+                    errors.extend(chunk_errors)
+                    self.stdout.write(".", ending="")
+                    self.stdout.flush()  # Ensure the dots are displayed immediately
+
         self.stdout.write(
             self.style.SUCCESS(
                 "\n%i categories successfully indexed" % categories.count()
             )
         )
+        if errors:
+            self.stderr.write(
+                "%i categories could not be indexed, the first error was: %s"
+                % (len(errors), errors[0])
+            )
+
+    def can_update_in_place(self):
+        """
+        Returns False when the mappings or settings of the index changed, so it
+        must be rebuilt. Settings that can be changed in place are updated.
+        """
+        indexer = CategoryElasticsearchIndex().indexer
+        changes = indexer.get_definition_changes()
+        if changes == indexer.DEFINITION_CHANGED:
+            self.stdout.write(
+                "The mappings or settings of the index changed, running a full reindex"
+            )
+            return False
+
+        if changes == indexer.DEFINITION_SETTINGS_CHANGED:
+            indexer.update_dynamic_settings()
+            self.stdout.write("The settings of the index were updated")
+
+        return True
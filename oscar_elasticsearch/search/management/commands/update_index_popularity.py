@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from oscar.core.loading import get_class
+
+ProductElasticsearchIndex = get_class("search.api.product", "ProductElasticsearchIndex")
+
+
+class Command(BaseCommand):
+    help = (
+        "Update the popularity of the indexed products of which the popularity "
+        "changed, without reindexing them."
+    )
+
+    def handle(self, *args, **options):
+        num_updated, errors = ProductElasticsearchIndex().update_popularity()
+
+        self.stdout.write(
+            self.style.SUCCESS("%i product popularities updated" % num_updated)
+        )
+        if errors:
+            self.stderr.write(
+                "%i products could not be updated, the first error was: %s"
+                % (len(errors), errors[0])
+            )
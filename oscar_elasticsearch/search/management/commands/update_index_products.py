@@ -1,12 +1,34 @@
+import cProfile
+import math
 import time
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import django
 from django.core.management.base import BaseCommand
-from oscar.core.loading import get_class, get_model
+from django.db import connection
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.encoding import force_str
+from oscar.core.loading import get_class, get_classes, get_model
 from oscar_elasticsearch.search import settings
 
-chunked = get_class("search.utils", "chunked")
+chunked, chunked_queryset, chunked_pk_ranges, split_range = get_classes(
+    "search.utils", ["chunked", "chunked_queryset", "chunked_pk_ranges", "split_range"]
+)
+get_changed_product_ids, reindex_product_range = get_classes(
+    "search.helpers", ["get_changed_product_ids", "reindex_product_range"]
+)
 ProductElasticsearchIndex = get_class("search.api.product", "ProductElasticsearchIndex")
+es = get_class("search.backend", "es")
 Product = get_model("catalogue", "Product")
 
+# Every worker gets a few id ranges, so a worker that finishes early can pick up
+# the remaining work of a slow one.
+RANGES_PER_WORKER = 4
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -15,41 +37,262 @@ class Command(BaseCommand):
             action="store_true",
             help="Run command in debug mode",
         )
+        parser.add_argument(
+            "--cprofile",
+            metavar="PATH",
+            help="With --debug, write a cProfile profile of the indexing to PATH",
+        )
+        parser.add_argument(
+            "--tracemalloc",
+            action="store_true",
+            help="With --debug, report the peak memory usage per chunk, this makes "
+            "the indexing a lot slower",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes used to build and index the product documents",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only index the products that changed since the index was last "
+            "updated, runs a full reindex when that is not known",
+        )
+        parser.add_argument(
+            "--if-changed",
+            action="store_true",
+            help="Only rebuild the index when its mappings or settings changed, "
+            "otherwise index the changed products like --incremental",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue the last reindex that did not finish, skipping the "
+            "products it already indexed",
+        )
 
     def handle(self, *args, **options):
         if options["debug"]:
-            return self.handle_debug()
+            return self.handle_debug(options["cprofile"], options["tracemalloc"])
+
+        if options["incremental"] and self.handle_incremental():
+            return
+
+        if options["if_changed"] and self.handle_if_changed():
+            return
+
+        if options["workers"] > 1:
+            return self.handle_parallel(options["workers"], options["resume"])
 
         products = Product.objects.all()
         products_total = products.count()
 
-        with ProductElasticsearchIndex().reindex() as index:
-            for chunk in chunked(products, settings.INDEXING_CHUNK_SIZE):
-                index.reindex_objects(chunk)
+        errors = []
+
+        with ProductElasticsearchIndex().reindex(options["resume"]) as index:
+            remaining_products = self.get_remaining_products(index)
+            previous_end_id = None
+            for start_id, end_id in chunked_pk_ranges(
+                remaining_products, settings.INDEXING_CHUNK_SIZE
+            ):
+                _, chunk_errors = index.reindex_objects(
+                    remaining_products.filter(pk__gte=start_id, pk__lte=end_id)
+                )
+                errors.extend(chunk_errors)
+
+                # The products between the previous chunk and this one were
+                # indexed before resuming, or did not exist.
+                if not chunk_errors:
+                    index.indexer.add_completed_range(
+                        start_id if previous_end_id is None else previous_end_id + 1,
+                        end_id,
+                    )
+                previous_end_id = end_id
+
                 self.stdout.write(".", ending="")
                 self.stdout.flush()  # Ensure the dots are displayed immediately
 
         self.stdout.write(
             self.style.SUCCESS("\n%i products successfully indexed" % products_total)
         )
+        self.report_errors(errors)
+
+    def get_remaining_products(self, index):
+        """
+        Returns the products that are not in the index yet, which are all
+        products unless the reindex was resumed.
+        """
+        if index.indexer.get_completed_ranges():
+            self.stdout.write("Resuming the reindex into %s" % index.indexer.alias_name)
+
+        return index.exclude_completed(Product.objects.all())
 
-    def handle_debug(self):
+    def handle_incremental(self):
         """
-        Display more detailed information about the indexing process, such as the time it took to index each chunk.
-        This is useful when debugging the performance of the indexing process.
+        Update the live index with the products that changed since the index was
+        last updated. Returns False when it is not known when that was.
         """
+        index = ProductElasticsearchIndex()
+        indexed_until = index.get_indexed_until()
+        if indexed_until is None:
+            self.stdout.write(
+                "It is not known when the index was last updated, running a full reindex"
+            )
+            return False
+
+        started = timezone.now()
+        product_ids = sorted(get_changed_product_ids(indexed_until))
+        errors = []
+
+        for chunk in chunked(product_ids, settings.INDEXING_CHUNK_SIZE):
+            _, chunk_errors = index.update_or_create(
+                Product.objects.filter(pk__in=chunk)
+            )
+            errors.extend(chunk_errors)
+            self.stdout.write(".", ending="")
+            self.stdout.flush()  # Ensure the dots are displayed immediately
+
+        # Products that failed must be picked up by the next run.
+        if not errors:
+            index.set_indexed_until(started)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "\n%i changed products successfully indexed" % len(product_ids)
+            )
+        )
+        self.report_errors(errors)
+        return True
+
+    def handle_if_changed(self):
+        """
+        Update the live index when its mappings and settings did not change,
+        settings that can be changed in place are updated. Returns False when the
+        index must be rebuilt.
+        """
+        indexer = ProductElasticsearchIndex().indexer
+        changes = indexer.get_definition_changes()
+        if changes == indexer.DEFINITION_CHANGED:
+            self.stdout.write(
+                "The mappings or settings of the index changed, running a full reindex"
+            )
+            return False
+
+        if changes == indexer.DEFINITION_SETTINGS_CHANGED:
+            indexer.update_dynamic_settings()
+            self.stdout.write("The settings of the index were updated")
+
+        return self.handle_incremental()
+
+    def handle_parallel(self, workers, resume=False):
+        """
+        Split the product id space into ranges and index those ranges in a pool of
+        worker processes. All workers write into the same new index, the alias is
+        only switched when every range was indexed successfully.
+        """
+        products_total = Product.objects.count()
+
+        errors = []
+
+        with ProductElasticsearchIndex().reindex(resume) as index:
+            products = self.get_remaining_products(index)
+            id_bounds = products.aggregate(min_id=Min("pk"), max_id=Max("pk"))
+            if id_bounds["min_id"] is not None:
+                errors = self.index_ranges(
+                    index,
+                    split_range(
+                        id_bounds["min_id"],
+                        id_bounds["max_id"],
+                        workers * RANGES_PER_WORKER,
+                    ),
+                    workers,
+                )
+
+        self.stdout.write(
+            self.style.SUCCESS("\n%i products successfully indexed" % products_total)
+        )
+        self.report_errors(errors)
+
+    def index_ranges(self, index, id_ranges, workers):
+        alias_name = force_str(index.indexer.alias_name)
+        # Workers are spawned instead of forked, so they don't share the database
+        # and elasticsearch connections of this process.
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        ) as executor:
+            futures = {
+                executor.submit(reindex_product_range, alias_name, start_id, end_id): (
+                    start_id,
+                    end_id,
+                )
+                for start_id, end_id in id_ranges
+            }
+            errors = []
+            try:
+                for future in as_completed(futures):
+                    range_errors = future.result()
+                    errors.extend(range_errors)
+                    if not range_errors:
+                        index.indexer.add_completed_range(*futures[future])
+                    self.stdout.write(".", ending="")
+                    self.stdout.flush()  # Ensure the dots are displayed immediately
+            except BaseException:
+                # Don't start any more ranges, the index will not be used anyway.
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        return errors
+
+    def report_errors(self, errors):
+        if errors:
+            self.stderr.write(
+                "%i products could not be indexed, the first error was: %s"
+                % (len(errors), errors[0])
+            )
+
+    def handle_debug(self, cprofile_path=None, trace_memory=False):
+        """
+        Display more detailed information about the indexing process, such as the
+        time it took to index each chunk, split into the stages of building and
+        sending the documents. This is useful when debugging the performance of
+        the indexing process.
+        """
+        profile = cProfile.Profile() if cprofile_path else None
+        if trace_memory:
+            tracemalloc.start()
+
         overall_start_time = time.time()
         products = Product.objects.all()
         products_total = products.count()
-        total_chunks = products_total / settings.INDEXING_CHUNK_SIZE
+        total_chunks = math.ceil(products_total / settings.INDEXING_CHUNK_SIZE)
         processed_chunks = 0
+        total_profiler = StageProfiler()
+        total_bytes = 0
+        peak_memory = 0
+        errors = []
+
+        if profile is not None:
+            profile.enable()
 
         with ProductElasticsearchIndex().reindex() as index:
-            for chunk in chunked(products, settings.INDEXING_CHUNK_SIZE):
+            for chunk in chunked_queryset(products, settings.INDEXING_CHUNK_SIZE):
+                if trace_memory:
+                    tracemalloc.reset_peak()
+
                 chunk_index_time = time.time()
-                index.reindex_objects(chunk)
+                profiler = StageProfiler()
+                chunk_errors, chunk_bytes = self.index_chunk_stages(
+                    index, chunk, profiler
+                )
+                errors.extend(chunk_errors)
                 processed_chunks += 1
                 chunk_duration = time.time() - chunk_index_time
+                total_profiler.add(profiler)
+                total_bytes += chunk_bytes
 
                 self.stdout.write(
                     self.style.SUCCESS(
@@ -66,6 +309,18 @@ class Command(BaseCommand):
                         )
                     )
                 )
+                self.stdout.write("  %s" % profiler.format_stages())
+                self.stdout.write("  %s sent" % format_bytes(chunk_bytes))
+                if trace_memory:
+                    chunk_peak_memory = tracemalloc.get_traced_memory()[1]
+                    peak_memory = max(peak_memory, chunk_peak_memory)
+                    self.stdout.write(
+                        "  peak memory: %s" % format_bytes(chunk_peak_memory)
+                    )
+
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(cprofile_path)
 
         total_duration = time.time() - overall_start_time
         self.stdout.write(
@@ -74,3 +329,95 @@ class Command(BaseCommand):
                 % (products_total, total_duration)
             )
         )
+        self.stdout.write("  %s" % total_profiler.format_stages())
+        self.stdout.write("  %s sent" % format_bytes(total_bytes))
+        if trace_memory:
+            tracemalloc.stop()
+            self.stdout.write("  peak memory: %s" % format_bytes(peak_memory))
+        if profile is not None:
+            self.stdout.write(
+                "Profile written to %s, inspect it with python -m pstats %s"
+                % (cprofile_path, cprofile_path)
+            )
+        self.report_errors(errors)
+
+    def index_chunk_stages(self, index, chunk, profiler):
+        """
+        Index a chunk of products like reindex_objects does, but finish every
+        stage before starting the next one, so they can be timed separately.
+        Returns the errors and the number of bytes of the documents.
+        """
+        if settings.FAST_PRODUCT_DOCUMENTS:
+            with profiler.stage("documents"):
+                documents = list(index.make_fast_documents(chunk))
+        else:
+            with profiler.stage("resources"):
+                product_resources = list(index.make_product_resources(chunk))
+            with profiler.stage("mapping"):
+                document_resources = list(
+                    index.map_product_resources(product_resources)
+                )
+            with profiler.stage("dump"):
+                documents = list(index.dump_documents(document_resources))
+        if index.FINGERPRINT_FIELD is not None:
+            with profiler.stage("fingerprint"):
+                documents = list(index.add_fingerprints(documents))
+
+        serializer = es.transport.serializers.get_serializer("application/json")
+        num_bytes = sum(len(serializer.dumps(doc["_source"])) for doc in documents)
+
+        with profiler.stage("bulk"):
+            _, errors = index.indexer.execute(documents)
+
+        return errors, num_bytes
+
+
+class StageProfiler(object):
+    """
+    Collects the time, the number of database queries and the time spent on
+    those queries per stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        self.current = self.stages.setdefault(
+            name, {"seconds": 0.0, "queries": 0, "query_seconds": 0.0}
+        )
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self.time_query):
+                yield
+        finally:
+            self.current["seconds"] += time.perf_counter() - started
+            self.current = None
+
+    def time_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.current["queries"] += 1
+            self.current["query_seconds"] += time.perf_counter() - started
+
+    def add(self, other):
+        for name, other_totals in other.stages.items():
+            totals = self.stages.setdefault(
+                name, {"seconds": 0.0, "queries": 0, "query_seconds": 0.0}
+            )
+            for key, value in other_totals.items():
+                totals[key] += value
+
+    def format_stages(self):
+        return ", ".join(
+            "%s: %.2fs (%i queries in %.2fs)"
+            % (name, totals["seconds"], totals["queries"], totals["query_seconds"])
+            for name, totals in self.stages.items()
+        )
+
+
+def format_bytes(num_bytes):
+    return "%.1f KB" % (num_bytes / 1024)
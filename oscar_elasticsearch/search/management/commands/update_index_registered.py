@@ -1,34 +1,211 @@
+import copy
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
 from oscar_elasticsearch.search.registry import elasticsearch_registry
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 from oscar.core.loading import get_class
 
 from oscar_elasticsearch.search import settings
 
-chunked = get_class("search.utils", "chunked")
+chunked_queryset = get_class("search.utils", "chunked_queryset")
 
 
 class Command(BaseCommand):
+    """
+    Rebuild the registered indexes. With a concurrency larger than 1 the indexes
+    are rebuilt at the same time in threads, an index is only started when the
+    indexes in its INDEXING_DEPENDENCIES are rebuilt.
+    """
+
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.INDEXING_CONCURRENCY,
+            help="Number of indexes that are rebuilt at the same time",
+        )
+
     def handle(self, *args, **options):
-        for Index in elasticsearch_registry.indexes:
-            index = Index()
+        failed = self.rebuild_indexes(
+            elasticsearch_registry.indexes, max(1, options["concurrency"])
+        )
+        if failed:
+            raise CommandError(
+                "Could not rebuild %s" % ", ".join(Index.__name__ for Index in failed)
+            )
+
+    def rebuild_indexes(self, indexes, concurrency):
+        """
+        Rebuild the indexes, at most ``concurrency`` at the same time. Returns
+        the indexes that failed, or were not started because an index they
+        depend on failed.
+        """
+        pending = list(indexes)
+        finished = []
+        failed = []
+        running = {}
+
+        executor = (
+            ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+        )
+        try:
+            while pending or running:
+                for Index in list(pending):
+                    dependencies = [
+                        dependency
+                        for dependency in Index.INDEXING_DEPENDENCIES
+                        if dependency in indexes
+                    ]
+                    if any(dependency in failed for dependency in dependencies):
+                        pending.remove(Index)
+                        failed.append(Index)
+                        self.stderr.write(
+                            "Skipped %s, because an index it depends on failed"
+                            % Index.__name__
+                        )
+                    elif len(running) < concurrency and all(
+                        dependency in finished for dependency in dependencies
+                    ):
+                        pending.remove(Index)
+                        if executor is not None:
+                            future = executor.submit(
+                                self.rebuild_index_in_thread, Index
+                            )
+                        else:
+                            future = run_inline(self.rebuild_index, Index)
+                        running[future] = Index
+
+                if not running:
+                    # What is left depends on each other, or on itself
+                    for Index in pending:
+                        self.stderr.write(
+                            "Skipped %s, because of circular dependencies"
+                            % Index.__name__
+                        )
+                    failed.extend(pending)
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    Index = running.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        finished.append(Index)
+                    else:
+                        failed.append(Index)
+                        self.stderr.write(
+                            "Rebuilding %s failed:\n%s"
+                            % (
+                                Index.__name__,
+                                "".join(
+                                    traceback.format_exception(
+                                        type(exception),
+                                        exception,
+                                        exception.__traceback__,
+                                    )
+                                ),
+                            )
+                        )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return failed
 
-            self.stdout.write(
-                self.style.SUCCESS(
-                    "\n Start indexing index: %s" % index.get_index_name()
-                )
+    def rebuild_index_in_thread(self, Index):
+        try:
+            return self.rebuild_index(Index)
+        finally:
+            # Every thread has its own database connections
+            connections.close_all()
+
+    def rebuild_index(self, Index):
+        index = Index()
+        index_name = index.get_index_name()
+        self.stdout.write(
+            self.style.SUCCESS("\n Start indexing index: %s" % index_name)
+        )
+
+        started = time.monotonic()
+        num_indexed = 0
+        errors = []
+        with index.reindex() as index:
+            chunks = chunked_queryset(
+                index.get_queryset(), index.get_indexing_chunk_size()
             )
+            for num_success, chunk_errors in self.reindex_chunks(index, chunks):
+                num_indexed += num_success
+                errors.extend(chunk_errors)
+                self.stdout.write(".", ending="")
+                self.stdout.flush()  # Ensure the dots are displayed immediately
 
-            index_queryset = index.get_queryset()
-            with index.reindex() as index:
-                for chunk in chunked(index_queryset, settings.INDEXING_CHUNK_SIZE):
-                    index.reindex_objects(chunk)
-                    self.stdout.write(".", ending="")
-                    self.stdout.flush()  # Ensure the dots are displayed immediately
-
-            self.stdout.write(
-                self.style.SUCCESS(
-                    "\n%i %s successfully indexed"
-                    % (index_queryset.count(), index.get_index_name())
-                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                "\n%i %s successfully indexed in %.1fs"
+                % (num_indexed, index_name, time.monotonic() - started)
+            )
+        )
+        if errors:
+            self.stderr.write(
+                "%i documents of %s could not be indexed, the first error was: %s"
+                % (len(errors), index_name, errors[0])
             )
+
+    def reindex_chunks(self, index, chunks):
+        """
+        Index the chunks, INDEXING_WORKERS of them at the same time, and yield
+        the number of indexed documents and the errors of every chunk.
+        """
+        if index.INDEXING_WORKERS <= 1:
+            for chunk in chunks:
+                yield index.reindex_objects(chunk)
+            return
+
+        # The indexer keeps track of the bulk chunk size and the progress, every
+        # thread gets its own that writes into the same index.
+        worker = threading.local()
+
+        def reindex_chunk(chunk):
+            if not hasattr(worker, "index"):
+                worker.index = copy.copy(index)
+                worker.index.indexer = index.indexer.copy()
+            try:
+                return worker.index.reindex_objects(chunk)
+            finally:
+                connections.close_all()
+
+        # Only a few chunks are read ahead, instead of all of them
+        max_pending = 2 * index.INDEXING_WORKERS
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=index.INDEXING_WORKERS) as executor:
+            try:
+                for chunk in chunks:
+                    pending.append(executor.submit(reindex_chunk, chunk))
+                    if len(pending) >= max_pending:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+
+def run_inline(fn, *args):
+    """
+    Run ``fn`` in the current thread, and return its outcome as a future.
+    """
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:  # pylint: disable=broad-except
+        future.set_exception(e)
+
+    return future
@@ -0,0 +1,182 @@
+from decimal import Decimal
+
+from django.db.models import Exists, OuterRef
+from django.utils.html import strip_tags
+
+from oscar.core.loading import get_class, get_classes, get_model
+
+from oscar_elasticsearch.search import settings
+
+Product = get_model("catalogue", "Product")
+ProductImage = get_model("catalogue", "ProductImage")
+
+(
+    format_price,
+    get_attribute_values_by_product,
+    get_category_ancestor_names,
+    get_product_attrs,
+    get_product_popularity,
+    get_product_priority,
+    get_product_status,
+    get_product_string_attrs,
+) = get_classes(
+    "search.mappings.products.mappings",
+    [
+        "format_price",
+        "get_attribute_values_by_product",
+        "get_category_ancestor_names",
+        "get_product_attrs",
+        "get_product_popularity",
+        "get_product_priority",
+        "get_product_status",
+        "get_product_string_attrs",
+    ],
+)
+
+
+class ProductDocumentBuilder(object):
+    """
+    Builds the same documents as ProductElasticSearchMapping, but straight from
+    the product models instead of mapping them to odin resources first, which is
+    a lot faster. Enable it with OSCAR_ELASTICSEARCH_FAST_PRODUCT_DOCUMENTS.
+
+    The odin mappings remain the way to customize the documents, when they are
+    customized this builder must be customized in the same way, or not be used.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        selector = get_class("partner.strategy", "Selector")
+        self.stock_strategy = selector().strategy()
+
+    def prefetch(self, queryset):
+        """
+        Prefetch only what the documents need. Whether a product has images is
+        annotated, instead of prefetching the images, and the attribute values
+        are loaded per chunk, see get_attribute_values_by_product.
+        """
+        return (
+            queryset.select_related("product_class", "parent__product_class")
+            .prefetch_browsable_categories()
+            .prefetch_related("stockrecords", "children")
+            .prefetch_public_children(
+                queryset=Product.objects.public().prefetch_related("stockrecords")
+            )
+            .annotate(
+                has_own_image=Exists(
+                    ProductImage.objects.filter(product=OuterRef("pk"))
+                ),
+                has_parent_image=Exists(
+                    ProductImage.objects.filter(product=OuterRef("parent_id"))
+                ),
+            )
+        )
+
+    def make_documents(self, queryset):
+        products = list(self.prefetch(queryset))
+        attribute_values = self.get_attribute_values(products)
+        for product in products:
+            yield {
+                "_id": product.id,
+                "_index": self.context.get("_index"),
+                "_op_type": "index",
+                "_source": self.make_source(product, attribute_values),
+            }
+
+    def get_attribute_values(self, products):
+        product_parents = {}
+        for product in products:
+            product_parents[product.id] = product.parent_id
+            if product.is_parent:
+                for child in product.children.all():
+                    product_parents[child.id] = product.id
+
+        return get_attribute_values_by_product(product_parents)
+
+    def make_source(self, product, attribute_values):
+        title = product.get_title()
+        attributes = attribute_values[product.id]
+        children = self.get_children(product, attribute_values)
+        price, currency, num_available, is_available = self.get_stock_info(product)
+        product_class = product.get_product_class()
+
+        return {
+            "id": product.id,
+            "content_type": "catalogue.product",
+            "title": title,
+            "search_title": title,
+            "title_auto_complete": title,
+            "is_public": product.is_public,
+            "code": product.upc,
+            "code_auto_complete": product.upc,
+            "upc": product.upc,
+            "description": product.description,
+            "absolute_url": None,
+            "slug": product.slug,
+            "structure": product.structure,
+            "rating": product.rating,
+            "priority": get_product_priority(product.priority, is_available),
+            "parent_id": product.parent_id,
+            "product_class": product_class.slug if product_class else None,
+            "price": price,
+            "currency": currency,
+            "num_available": num_available,
+            "is_available": is_available,
+            "categories": self.get_categories(product),
+            "attrs": get_product_attrs(
+                attributes, [child_attributes for _, _, child_attributes in children]
+            ),
+            "date_created": product.date_created,
+            "date_updated": product.date_updated,
+            "string_attrs": get_product_string_attrs(attributes, children),
+            "popularity": get_product_popularity(product.id, self.context, product),
+            "status": get_product_status(
+                product.is_public, is_available, product.structure
+            ),
+            "suggest": [
+                title if field == "title" else getattr(product, field)
+                for field in settings.AUTOCOMPLETE_SEARCH_FIELDS
+            ],
+            # Child products without images use the images of their parent
+            "has_image": product.has_own_image
+            or (product.is_child and product.has_parent_image),
+        }
+
+    def get_children(self, product, attribute_values):
+        """
+        Returns the title, upc and attributes of the children of a parent product.
+        """
+        if not product.is_parent:
+            return []
+
+        return [
+            (child.get_title(), child.upc, attribute_values[child.id])
+            for child in product.children.all()
+        ]
+
+    def get_stock_info(self, product):
+        if product.is_parent:
+            stock_info = self.stock_strategy.fetch_for_parent(product)
+        else:
+            stock_info = self.stock_strategy.fetch_for_product(product)
+
+        price = getattr(stock_info.price, "incl_tax", Decimal(0))
+        return (
+            format_price(price),
+            getattr(stock_info.price, "currency", ""),
+            getattr(stock_info.availability, "num_available", 0),
+            stock_info.availability.is_available_to_buy,
+        )
+
+    def get_categories(self, product):
+        return [
+            {
+                "id": category.id,
+                "description": strip_tags(category.description),
+                "name": category.name,
+                "ancestor_names": get_category_ancestor_names(
+                    category.id, self.context
+                ),
+            }
+            for category in product.get_categories()
+        ]
@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 import odin
 
 from django.utils import timezone
@@ -16,8 +18,11 @@ from oscar_elasticsearch.search.constants import (
 from oscar_elasticsearch.search import settings
 
 Product = get_model("catalogue", "Product")
+ProductAttribute = get_model("catalogue", "ProductAttribute")
+ProductAttributeValue = get_model("catalogue", "ProductAttributeValue")
 Line = get_model("order", "Line")
 
+ProductToResource = get_class("oscar_odin.mappings.catalogue", "ProductToResource")
 ProductResource = get_class("oscar_odin.resources.catalogue", "ProductResource")
 CategoryResource = get_class("oscar_odin.resources.catalogue", "CategoryResource")
 
@@ -40,6 +45,210 @@ ProductElasticSearchResource = get_class(
 ATTRIBUTES_TO_INDEX = get_attributes_to_index().keys()
 
 
+def format_price(price):
+    # The same string as oscar_odin's DecimalField dumps in the complete documents
+    if price is None:
+        return None
+
+    return str(round(Decimal(price), 2))
+
+
+def get_product_priority(priority, is_available_to_buy):
+    if not is_available_to_buy and settings.PRIORITIZE_AVAILABLE_PRODUCTS:
+        return -1
+
+    return priority
+
+
+def get_product_status(is_public, is_available_to_buy, structure):
+    ctx = []
+
+    if not is_public:
+        return ["n"]
+
+    ctx.append(ES_CTX_PUBLIC)
+
+    # non public items are not available or browsable
+    if is_available_to_buy:
+        ctx.append(ES_CTX_AVAILABLE)
+
+    # depending on FILTER_AVAILABLE things are browsable only if
+    # they are available
+    is_browsable = structure in [Product.STANDALONE, Product.PARENT]
+    if not settings.FILTER_AVAILABLE and is_browsable:
+        ctx.append(ES_CTX_BROWSABLE)
+    elif is_available_to_buy and is_browsable:
+        ctx.append(ES_CTX_BROWSABLE)
+
+    return ctx
+
+
+def get_product_popularity(product_id, context, model_instance=None):
+    # The popularity of all products is looked up at once when reindexing.
+    if "popularity" in context:
+        return context["popularity"].get(product_id)
+
+    # In our search.api.product make_documents method, we annotate the popularity, this way
+    # we don't have to do N+1 queries to get the popularity of each product.
+    if model_instance is not None and hasattr(model_instance, "popularity"):
+        return model_instance.popularity
+
+    # Fallback to n+1 query, though, try to avoid this.
+    months_to_run = settings.MONTHS_TO_RUN_ANALYTICS
+    orders_above_date = timezone.now() - relativedelta(months=months_to_run)
+
+    return Line.objects.filter(
+        product_id=product_id, order__date_placed__gte=orders_above_date
+    ).count()
+
+
+def get_category_ancestor_names(category_id, context):
+    names = []
+    if category_id in context["category_ancestors"]:
+        names = [
+            context["category_titles"][ancestor_id]
+            for ancestor_id in context["category_ancestors"][category_id]
+        ]
+    return " | ".join(names)
+
+
+def get_attribute_values(attr_dict, code):
+    if code not in attr_dict:
+        return []
+    attribute = attr_dict[code]
+    if isinstance(attribute, QuerySet):
+        return [str(o) for o in attribute]
+    if isinstance(attribute, list):
+        return [str(item) for item in attribute]
+    else:
+        return [str(attribute)]
+
+
+def get_product_attrs(attributes, children_attributes):
+    """
+    Returns the values of the attributes to index of a product and its children.
+    """
+    values = {
+        code: get_attribute_values(attributes, code) for code in ATTRIBUTES_TO_INDEX
+    }
+    for child_attributes in children_attributes:
+        for code in ATTRIBUTES_TO_INDEX:
+            if code in child_attributes:
+                values[code].extend(get_attribute_values(child_attributes, code))
+
+    return {
+        code: code_values[0] if len(code_values) == 1 else code_values
+        for code, code_values in values.items()
+        if code_values
+    }
+
+
+def get_product_string_attrs(attributes, children):
+    """
+    Returns all attribute values of a product as text, followed by the title,
+    upc and attribute values of every child.
+    """
+    string_attrs = [str(value) for value in attributes.values()]
+    for title, upc, child_attributes in children:
+        string_attrs.append(title)
+        string_attrs.append(upc)
+        string_attrs.extend(str(value) for value in child_attributes.values())
+
+    return string_attrs
+
+
+# The attribute types of which the value can be read from the row itself
+ATTRIBUTE_VALUE_FIELDS = {
+    ProductAttribute.TEXT: "value_text",
+    ProductAttribute.INTEGER: "value_integer",
+    ProductAttribute.BOOLEAN: "value_boolean",
+    ProductAttribute.FLOAT: "value_float",
+    ProductAttribute.RICHTEXT: "value_richtext",
+    ProductAttribute.DATE: "value_date",
+    ProductAttribute.DATETIME: "value_datetime",
+    ProductAttribute.OPTION: "value_option__option",
+}
+
+
+def get_attribute_values_by_product(product_parents):
+    """
+    Returns the attribute values of products as native types, by product id and
+    attribute code, the same as the attributes of their odin resources. Child
+    products get the values of their parent, unless they have a value of the
+    attribute themselves.
+
+    ``product_parents`` maps the ids of the products to the ids of their parent.
+    All values are read in at most three queries, however many products there
+    are, instead of building a model instance for every value and option.
+    """
+    product_ids = set(product_parents) | {
+        parent_id for parent_id in product_parents.values() if parent_id is not None
+    }
+
+    rows = (
+        ProductAttributeValue.objects.filter(product_id__in=product_ids)
+        .order_by("pk")
+        .values(
+            "pk",
+            "product_id",
+            "value_option_id",
+            "attribute__code",
+            "attribute__type",
+            *ATTRIBUTE_VALUE_FIELDS.values(),
+        )
+    )
+
+    own_values = {product_id: {} for product_id in product_ids}
+    multi_option_values = {}
+    instance_values = {}
+    for row in rows:
+        values = own_values[row["product_id"]]
+        code = row["attribute__code"]
+        attribute_type = row["attribute__type"]
+        if attribute_type == ProductAttribute.MULTI_OPTION:
+            values[code] = multi_option_values[row["pk"]] = []
+        elif attribute_type in ATTRIBUTE_VALUE_FIELDS and not (
+            attribute_type == ProductAttribute.OPTION and row["value_option_id"] is None
+        ):
+            values[code] = row[ATTRIBUTE_VALUE_FIELDS[attribute_type]]
+        else:
+            # Files, images and entities are converted like the odin resources do
+            values[code] = None
+            instance_values[row["pk"]] = (values, code)
+
+    if multi_option_values:
+        options = (
+            ProductAttributeValue.value_multi_option.through.objects.filter(
+                productattributevalue_id__in=multi_option_values
+            )
+            .order_by("pk")
+            .values_list("productattributevalue_id", "attributeoption__option")
+        )
+        for value_id, option in options:
+            multi_option_values[value_id].append(option)
+
+    if instance_values:
+        # pylint: disable=protected-access
+        to_native_type = ProductToResource._attribute_value_to_native_type
+        for item in ProductAttributeValue.objects.filter(
+            pk__in=instance_values
+        ).select_related("attribute", "value_option"):
+            values, code = instance_values[item.pk]
+            values[code] = to_native_type(item)
+
+    attribute_values = {}
+    for product_id, parent_id in product_parents.items():
+        if parent_id is None:
+            attribute_values[product_id] = own_values[product_id]
+        else:
+            attribute_values[product_id] = {
+                **own_values[parent_id],
+                **own_values[product_id],
+            }
+
+    return attribute_values
+
+
 class CategoryRelatedMapping(OscarBaseMapping):
     from_resource = CategoryResource
     to_resource = CategoryElasticSearchRelatedResource
@@ -51,13 +260,7 @@ class CategoryRelatedMapping(OscarBaseMapping):
     @odin.assign_field
     def ancestor_names(self) -> str:
         """Map names of all of the category ancestors."""
-        names = []
-        if self.source.id in self.context["category_ancestors"]:
-            names = [
-                self.context["category_titles"][ancestor_id]
-                for ancestor_id in self.context["category_ancestors"][self.source.id]
-            ]
-        return " | ".join(names)
+        return get_category_ancestor_names(self.source.id, self.context)
 
 
 class ProductMapping(OscarBaseMapping):
@@ -79,30 +282,13 @@ class ProductMapping(OscarBaseMapping):
 
     @odin.map_field(from_field="priority")
     def priority(self, priority):
-        if (
-            not self.source.is_available_to_buy
-            and settings.PRIORITIZE_AVAILABLE_PRODUCTS
-        ):
-            return -1
-
-        return priority
+        return get_product_priority(priority, self.source.is_available_to_buy)
 
     @odin.assign_field
     def popularity(self):
-        # In our search.api.product make_documents method, we annotate the popularity, this way
-        # we don't have to do N+1 queries to get the popularity of each product.
-        if hasattr(self.source, "model_instance") and hasattr(
-            self.source.model_instance, "popularity"
-        ):
-            return self.source.model_instance.popularity
-
-        # Fallback to n+1 query, though, try to avoid this.
-        months_to_run = settings.MONTHS_TO_RUN_ANALYTICS
-        orders_above_date = timezone.now() - relativedelta(months=months_to_run)
-
-        return Line.objects.filter(
-            product_id=self.source.id, order__date_placed__gte=orders_above_date
-        ).count()
+        return get_product_popularity(
+            self.source.id, self.context, getattr(self.source, "model_instance", None)
+        )
 
     @odin.assign_field
     def content_type(self) -> str:
@@ -114,67 +300,33 @@ class ProductMapping(OscarBaseMapping):
 
     @odin.map_field(from_field="attributes")
     def attrs(self, attributes):
-        attrs = {}
-
-        def get_attribute_values(attr_dict, code):
-            if code not in attr_dict:
-                return []
-            attribute = attr_dict[code]
-            if isinstance(attribute, QuerySet):
-                return [str(o) for o in attribute]
-            if isinstance(attribute, list):
-                return [str(item) for item in attribute]
-            else:
-                return [str(attribute)]
-
-        for code in ATTRIBUTES_TO_INDEX:
-            values = []
-
-            if code in attributes:
-                values = get_attribute_values(attributes, code)
-
-            if self.source.structure == Product.PARENT:
-                for child in self.source.children:
-                    values.extend(get_attribute_values(child.attributes, code))
-
-            if values:
-                attrs[code] = values[0] if len(values) == 1 else values
-
-        return attrs
+        return get_product_attrs(
+            attributes, [child.attributes for child in self.get_children()]
+        )
 
     @odin.assign_field(to_list=True)
     def status(self):
-        ctx = []
-
-        if not self.source.is_public:
-            return ["n"]
-
-        ctx.append(ES_CTX_PUBLIC)
-
-        # non public items are not available or browsable
-        if self.source.is_available_to_buy:
-            ctx.append(ES_CTX_AVAILABLE)
-
-        # depending on FILTER_AVAILABLE things are browsable only if
-        # they are available
-        is_browsable = self.source.structure in [Product.STANDALONE, Product.PARENT]
-        if not settings.FILTER_AVAILABLE and is_browsable:
-            ctx.append(ES_CTX_BROWSABLE)
-        elif self.source.is_available_to_buy and is_browsable:
-            ctx.append(ES_CTX_BROWSABLE)
-
-        return ctx
+        return get_product_status(
+            self.source.is_public,
+            self.source.is_available_to_buy,
+            self.source.structure,
+        )
 
     @odin.assign_field(to_list=True)
     def string_attrs(self):
-        attrs = [str(a) for a in self.source.attributes.values()]
+        return get_product_string_attrs(
+            self.source.attributes,
+            [
+                (child.title, child.upc, child.attributes)
+                for child in self.get_children()
+            ],
+        )
+
+    def get_children(self):
         if self.source.structure == Product.PARENT:
-            for child in self.source.children:
-                attrs.append(child.title)
-                attrs.append(child.upc)
-                attrs.extend([str(a) for a in child.attributes.values()])
+            return self.source.children
 
-        return attrs
+        return []
 
     @odin.map_field(
         from_field=settings.AUTOCOMPLETE_SEARCH_FIELDS, to_field="suggest", to_list=True
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "object_type",
+                    models.CharField(
+                        choices=[
+                            ("product", "Product"),
+                            ("category", "Category"),
+                            ("product_stock", "Product stock"),
+                            ("product_delete", "Deleted product"),
+                        ],
+                        max_length=32,
+                        verbose_name="Object type",
+                    ),
+                ),
+                (
+                    "object_id",
+                    models.CharField(max_length=64, verbose_name="Object id"),
+                ),
+                (
+                    "attempts",
+                    models.PositiveIntegerField(default=0, verbose_name="Attempts"),
+                ),
+                ("last_error", models.TextField(blank=True, verbose_name="Last error")),
+                (
+                    "date_created",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Date created"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Outbox entry",
+                "verbose_name_plural": "Outbox entries",
+                "ordering": ["pk"],
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        fields=["object_type", "attempts"],
+                        name="search_outb_object__4239f6_idx",
+                    )
+                ],
+            },
+        ),
+    ]
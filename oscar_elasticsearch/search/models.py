@@ -0,0 +1,14 @@
+# pylint: disable=W0401
+from oscar.core.loading import is_model_registered
+
+from .abstract_models import AbstractOutboxEntry
+
+__all__ = []
+
+
+if not is_model_registered("search", "OutboxEntry"):
+
+    class OutboxEntry(AbstractOutboxEntry):
+        pass
+
+    __all__.append("OutboxEntry")
@@ -0,0 +1,103 @@
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from oscar.core.loading import get_classes, get_model
+
+(
+    update_index_products,
+    update_index_categories,
+    update_index_product_stock,
+    delete_products,
+) = get_classes(
+    "search.helpers",
+    [
+        "update_index_products",
+        "update_index_categories",
+        "update_index_product_stock",
+        "delete_products",
+    ],
+)
+OutboxEntry = get_model("search", "OutboxEntry")
+
+
+def add_to_outbox(object_type, object_ids):
+    OutboxEntry.objects.bulk_create(
+        [
+            OutboxEntry(object_type=object_type, object_id=str(object_id))
+            for object_id in object_ids
+        ]
+    )
+
+
+def get_outbox_handlers():
+    """
+    Maps the object types in the outbox to the function that indexes them. The
+    functions receive a list of ids and return the errors of the documents that
+    could not be indexed.
+    """
+    return {
+        OutboxEntry.PRODUCT: update_index_products,
+        OutboxEntry.CATEGORY: update_index_categories,
+        OutboxEntry.PRODUCT_STOCK: update_index_product_stock,
+        OutboxEntry.PRODUCT_DELETE: delete_products,
+    }
+
+
+def process_outbox(batch_size, max_attempts):
+    """
+    Index a batch of the oldest outbox entries of every object type. Entries for
+    the same object are indexed once, entries that fail are kept and retried until
+    they failed max_attempts times. Returns the number of processed entries.
+    """
+    num_processed = 0
+
+    for object_type, update_index in get_outbox_handlers().items():
+        with transaction.atomic():
+            # skip_locked allows running multiple workers next to each other.
+            entries = list(
+                OutboxEntry.objects.select_for_update(skip_locked=True)
+                .filter(object_type=object_type, attempts__lt=max_attempts)
+                .values_list("pk", "object_id")[:batch_size]
+            )
+            if not entries:
+                continue
+
+            object_ids = sorted({object_id for _, object_id in entries})
+            try:
+                with transaction.atomic():
+                    errors = update_index(object_ids)
+            except Exception as e:  # pylint: disable=broad-except
+                failed_ids, last_error = set(object_ids), repr(e)
+            else:
+                failed_ids = {str(list(error.values())[0]["_id"]) for error in errors}
+                last_error = str(errors[0]) if errors else ""
+
+            failed_entries = [
+                pk for pk, object_id in entries if object_id in failed_ids
+            ]
+            OutboxEntry.objects.filter(pk__in=failed_entries).update(
+                attempts=F("attempts") + 1, last_error=last_error
+            )
+            OutboxEntry.objects.filter(
+                pk__in=[pk for pk, _ in entries if pk not in failed_entries]
+            ).delete()
+
+            num_processed += len(entries)
+
+    return num_processed
+
+
+def get_outbox_depth(max_attempts):
+    """
+    Returns the number of pending and failed entries in the outbox per object type.
+    Failed entries will not be retried anymore.
+    """
+    return {
+        row["object_type"]: (row["pending"], row["failed"])
+        for row in OutboxEntry.objects.order_by()
+        .values("object_type")
+        .annotate(
+            pending=Count("pk", filter=Q(attempts__lt=max_attempts)),
+            failed=Count("pk", filter=Q(attempts__gte=max_attempts)),
+        )
+    }
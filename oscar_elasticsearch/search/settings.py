@@ -141,6 +141,59 @@ DEFAULT_ORDERING = getattr(settings, "OSCAR_ELASTICSEARCH_DEFAULT_ORDERING", Non
 FACET_BUCKET_SIZE = getattr(settings, "OSCAR_ELASTICSEARCH_FACET_BUCKET_SIZE", 10)
 
 INDEXING_CHUNK_SIZE = getattr(settings, "OSCAR_ELASTICSEARCH_INDEXING_CHUNK_SIZE", 400)
+INDEXING_CONCURRENCY = getattr(settings, "OSCAR_ELASTICSEARCH_INDEXING_CONCURRENCY", 1)
+INDEXING_BULK_CHUNK_SIZE = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_CHUNK_SIZE", 500
+)
+INDEXING_BULK_MIN_CHUNK_SIZE = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_MIN_CHUNK_SIZE", 50
+)
+INDEXING_BULK_MAX_CHUNK_SIZE = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_MAX_CHUNK_SIZE", 5000
+)
+INDEXING_BULK_TARGET_SECONDS = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_TARGET_SECONDS", 1.0
+)
+INDEXING_BULK_MAX_RETRIES = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_MAX_RETRIES", 3
+)
+INDEXING_BULK_INITIAL_BACKOFF = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_INITIAL_BACKOFF", 2
+)
+INDEXING_BULK_MAX_BYTES = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_MAX_BYTES", 10 * 1024 * 1024
+)
+INDEXING_BULK_THREAD_COUNT = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_THREAD_COUNT", 1
+)
+INDEXING_BULK_LOAD = getattr(settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_LOAD", True)
+INDEXING_BULK_LOAD_ASYNC_TRANSLOG = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_BULK_LOAD_ASYNC_TRANSLOG", False
+)
+INDEXING_FORCE_MERGE_SEGMENTS = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_FORCE_MERGE_SEGMENTS", None
+)
+INDEXING_WAIT_FOR_STATUS = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_WAIT_FOR_STATUS", "yellow"
+)
+INDEXING_WAIT_FOR_STATUS_TIMEOUT = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_WAIT_FOR_STATUS_TIMEOUT", "5m"
+)
+INDEXING_STALE_TIMEOUT = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_STALE_TIMEOUT", 3600
+)
+INDEXING_CHECKPOINT_INTERVAL = getattr(
+    settings, "OSCAR_ELASTICSEARCH_INDEXING_CHECKPOINT_INTERVAL", 10
+)
+
+FAST_PRODUCT_DOCUMENTS = getattr(
+    settings, "OSCAR_ELASTICSEARCH_FAST_PRODUCT_DOCUMENTS", False
+)
+
+ALIAS_CACHE_TIMEOUT = getattr(settings, "OSCAR_ELASTICSEARCH_ALIAS_CACHE_TIMEOUT", 10)
+
+USE_OUTBOX = getattr(settings, "OSCAR_ELASTICSEARCH_USE_OUTBOX", False)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, "OSCAR_ELASTICSEARCH_OUTBOX_MAX_ATTEMPTS", 5)
 
 PRIORITIZE_AVAILABLE_PRODUCTS = getattr(
     settings, "OSCAR_ELASTICSEARCH_PRIORITIZE_AVAILABLE_PRODUCTS", True
@@ -153,3 +206,10 @@ PRODUCTS_WITH_IMAGES_FIRST = getattr(
 HIDE_IMAGELESS_PRODUCTS = getattr(
     settings, "OSCAR_ELASTICSEARCH_HIDE_IMAGELESS_PRODUCTS", False
 )
+
+CATEGORY_CONTEXT_CACHE = getattr(
+    settings, "OSCAR_ELASTICSEARCH_CATEGORY_CONTEXT_CACHE", "default"
+)
+CATEGORY_CONTEXT_CACHE_TIMEOUT = getattr(
+    settings, "OSCAR_ELASTICSEARCH_CATEGORY_CONTEXT_CACHE_TIMEOUT", 3600
+)
@@ -2,6 +2,7 @@
 from oscar.core.loading import get_model, get_class
 
 from django.core.signals import request_finished
+from django.db import transaction
 from django.db.models.signals import post_delete, post_save, m2m_changed
 
 from . import settings
@@ -10,7 +11,7 @@ Product = get_model("catalogue", "Product")
 Category = get_model("catalogue", "Category")
 StockRecord = get_model("partner", "StockRecord")
 UpdateIndex = get_class("search.update", "UpdateIndex")
-ProductElasticsearchIndex = get_class("search.api.product", "ProductElasticsearchIndex")
+bump_category_tree_version = get_class("search.utils", "bump_category_tree_version")
 
 update_index = UpdateIndex()
 
@@ -22,6 +23,13 @@ def push_product_update(instance):
         update_index.push_product(str(instance.parent_id))
 
 
+def push_product_stock_update(product):
+    # the price and availability of a parent depend on its children
+    update_index.push_product_stock(str(product.pk))
+    if product.is_child:
+        update_index.push_product_stock(str(product.parent_id))
+
+
 def product_post_save_signal_handler(sender, instance, **kwargs):
     if kwargs.get("raw", False):
         return
@@ -33,26 +41,36 @@ def product_post_delete_signal_handler(sender, instance, **kwargs):
     if kwargs.get("raw", False):
         return
 
-    ProductElasticsearchIndex().delete(instance.pk)
+    update_index.push_product_delete(str(instance.pk))
 
 
 def product_category_m2m_changed_signal_handler(
-    sender, instance, action, reverse, **kwargs
+    sender, instance, action, reverse, pk_set=None, **kwargs
 ):
     if kwargs.get("raw", False):
         return
 
-    if action.startswith("post"):
-        if reverse:
-            update_index.push_category(str(instance.pk))
-        else:
-            push_product_update(instance)
+    if reverse:
+        # The category itself did not change, but the products that were added
+        # to or removed from it did.
+        if action == "pre_clear":
+            product_ids = sender.objects.filter(category=instance).values_list(
+                "product_id", flat=True
+            )
+            update_index.push_product(*[str(pk) for pk in product_ids])
+        elif action in ["post_add", "post_remove"]:
+            update_index.push_product(*[str(pk) for pk in pk_set])
+    elif action.startswith("post"):
+        push_product_update(instance)
 
 
 def category_change_handler(sender, instance, **kwargs):
     if kwargs.get("raw", False):
         return
 
+    # Bump after the commit, otherwise another process could cache the old
+    # category tree under the new version.
+    transaction.on_commit(bump_category_tree_version)
     update_index.push_category(str(instance.pk))
 
 
@@ -60,14 +78,14 @@ def stockrecord_change_handler(sender, instance, **kwargs):
     if kwargs.get("raw", False):
         return
 
-    push_product_update(instance.product)
+    push_product_stock_update(instance.product)
 
 
 def stockrecord_post_delete_handler(sender, instance, **kwargs):
     if kwargs.get("raw", False):
         return
 
-    push_product_update(instance.product)
+    push_product_stock_update(instance.product)
 
 
 def register_signal_handlers():
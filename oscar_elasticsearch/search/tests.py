@@ -1,14 +1,28 @@
 import doctest
-from unittest.mock import patch
+import shutil
+import tempfile
+from concurrent.futures import Future
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import Mock, patch
 
 from time import sleep
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.encoding import force_str
 from django.urls import reverse
 
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+from elasticsearch import ApiError
+
 from oscar.core.loading import get_class, get_model
 from oscar.test.factories import (
     ProductFactory,
+    ProductImageFactory,
     OrderFactory,
     OrderLineFactory,
 )
@@ -17,10 +31,17 @@ import oscar_elasticsearch.search.format
 import oscar_elasticsearch.search.utils
 
 Product = get_model("catalogue", "Product")
+User = get_model("auth", "User")
 Category = get_model("catalogue", "Category")
+StockRecord = get_model("partner", "StockRecord")
+OutboxEntry = get_model("search", "OutboxEntry")
 
 update_index_products = get_class("search.helpers", "update_index_products")
 update_index_categories = get_class("search.helpers", "update_index_categories")
+chunked_queryset = get_class("search.utils", "chunked_queryset")
+es = get_class("search.backend", "es")
+add_to_outbox = get_class("search.outbox", "add_to_outbox")
+bump_category_tree_version = get_class("search.utils", "bump_category_tree_version")
 
 ProductElasticsearchIndex = get_class("search.api.product", "ProductElasticsearchIndex")
 CategoryElasticsearchIndex = get_class(
@@ -34,6 +55,36 @@ def load_tests(loader, tests, ignore):  # pylint: disable=W0613
     return tests
 
 
+class InlineExecutor:
+    """
+    Stands in for the ProcessPoolExecutor of update_index_products --workers,
+    the submitted calls are run right away in the test process.
+    """
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        self.shutdown_calls = []
+        self.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:  # pylint: disable=broad-except
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, _wait=True, cancel_futures=False):
+        self.shutdown_calls.append(cancel_futures)
+
+
 class ElasticSearchViewTest(TestCase):
     fixtures = [
         "search/auth",
@@ -162,6 +213,8 @@ class ManagementCommandsTestCase(TestCase):
         "catalogue/catalogue",
     ]
 
+    # Unfinished indices of other tests are deleted
+    @patch("oscar_elasticsearch.search.settings.INDEXING_STALE_TIMEOUT", 0)
     def setUp(self):
         # Clear index before each test
         with ProductElasticsearchIndex().reindex() as index:
@@ -199,6 +252,19 @@ class ManagementCommandsTestCase(TestCase):
         self.assertEqual(results.count(), 6)
         self.assertEqual(total_hits, 6)
 
+    def test_update_index_products_debug(self):
+        out = StringIO()
+        call_command("update_index_products", "--debug", "--tracemalloc", stdout=out)
+
+        self.assertIn("resources: ", out.getvalue())
+        self.assertIn("bulk: ", out.getvalue())
+        self.assertIn("peak memory: ", out.getvalue())
+        sleep(3)
+
+        results, total_hits = self.product_index.search()
+        self.assertEqual(results.count(), 6)
+        self.assertEqual(total_hits, 6)
+
     def test_update_index_categories(self):
         results, total_hits = self.category_index.search()
         self.assertEqual(results.count(), 0)
@@ -239,14 +305,14 @@ class ManagementCommandsTestCase(TestCase):
         create_parent_child_products()
         self.assertEqual(Product.objects.count(), 66)  # 6 inside the fixtures
 
-        with self.assertNumQueries(24):
+        with self.assertNumQueries(25):
             call_command("update_index_products")
 
         # create 10 extra product with each 5 childs
         create_parent_child_products()
 
         # The amount of queries should not change.
-        with self.assertNumQueries(24):
+        with self.assertNumQueries(25):
             call_command("update_index_products")
 
     def test_popularity_based_on_order_lines(self):
@@ -290,6 +356,21 @@ class ManagementCommandsTestCase(TestCase):
                 quantity,
             )
 
+    def test_update_index_popularity(self):
+        call_command("update_index_products")
+
+        order = OrderFactory()
+        for _ in range(2):
+            OrderLineFactory(order=order, product=Product.objects.get(pk=3))
+
+        call_command("update_index_popularity")
+        sleep(3)
+
+        popularity = ProductElasticsearchIndex().indexer.get_all_source_field(
+            "popularity"
+        )
+        self.assertEqual(popularity, {"3": 2})
+
     def test_exception_does_not_delete_index(self):
         call_command("update_index_products")
         sleep(3)
@@ -309,6 +390,663 @@ class ManagementCommandsTestCase(TestCase):
         self.assertEqual(results.count(), 6)
         self.assertEqual(total_hits, 6)
 
+    @patch(
+        "oscar_elasticsearch.search.management.commands.update_index_products"
+        ".ProcessPoolExecutor",
+        InlineExecutor,
+    )
+    def test_update_index_products_workers(self):
+        indexer = ProductElasticsearchIndex().indexer
+        old_index = indexer.get_current_alias()
+
+        call_command("update_index_products", workers=2)
+
+        new_index = indexer.get_current_alias()
+        self.assertNotEqual(new_index, old_index)
+        self.assertEqual(len(indexer.get_all_source_field("id", new_index)), 6)
+        self.assertIsNone(indexer.get_meta(new_index)["completed_ranges"])
+
+    @patch(
+        "oscar_elasticsearch.search.management.commands.update_index_products"
+        ".ProcessPoolExecutor",
+        InlineExecutor,
+    )
+    def test_update_index_products_workers_popularity(self):
+        with patch.object(
+            ProductElasticsearchIndex, "get_popularity", return_value={3: 2}
+        ) as get_popularity:
+            call_command("update_index_products", workers=2)
+
+        # Once for the reindex, and once in the worker instead of for every range
+        self.assertEqual(get_popularity.call_count, 2)
+        self.assertNotIn("popularity", ProductElasticsearchIndex.context)
+        popularity = ProductElasticsearchIndex().indexer.get_source_field(
+            ["3"], "popularity"
+        )
+        self.assertEqual(popularity, {"3": 2})
+
+    def test_reindex_popularity_is_not_shared(self):
+        with ProductElasticsearchIndex().reindex():
+            self.assertNotIn("popularity", ProductElasticsearchIndex.context)
+            self.assertNotIn("popularity", ProductElasticsearchIndex().context)
+
+    @patch(
+        "oscar_elasticsearch.search.management.commands.update_index_products"
+        ".ProcessPoolExecutor",
+        InlineExecutor,
+    )
+    def test_update_index_products_workers_failure(self):
+        from oscar_elasticsearch.search.management.commands import (
+            update_index_products as command,
+        )
+
+        call_command("update_index_products")
+        indexer = ProductElasticsearchIndex().indexer
+        old_index = indexer.get_current_alias()
+
+        def fail_on_product_5(alias_name, start_id, end_id):
+            if start_id <= 5 <= end_id:
+                raise RuntimeError("Killed")
+            return reindex_product_range(alias_name, start_id, end_id)
+
+        reindex_product_range = command.reindex_product_range
+        InlineExecutor.instances.clear()
+        with patch.object(command, "reindex_product_range", fail_on_product_5):
+            with self.assertRaises(RuntimeError):
+                call_command("update_index_products", workers=2)
+
+        # The alias was not switched and the remaining ranges were cancelled
+        self.assertEqual(indexer.get_current_alias(), old_index)
+        self.assertEqual(len(indexer.get_all_source_field("id")), 6)
+        self.assertEqual(len(InlineExecutor.instances), 1)
+        self.assertIn(True, InlineExecutor.instances[0].shutdown_calls)
+
+    @patch("oscar_elasticsearch.search.settings.INDEXING_CHUNK_SIZE", 2)
+    @patch("oscar_elasticsearch.search.settings.INDEXING_STALE_TIMEOUT", 0)
+    def test_update_index_products_resume(self):
+        reindex_objects = ProductElasticsearchIndex.reindex_objects
+        indexed_chunks = []
+
+        def fail_on_second_chunk(index, objects):
+            indexed_chunks.append(sorted(objects.values_list("pk", flat=True)))
+            if indexed_chunks == [[2, 3], [4, 5]]:
+                raise RuntimeError("Killed")
+            return reindex_objects(index, objects)
+
+        with patch.object(
+            ProductElasticsearchIndex, "reindex_objects", fail_on_second_chunk
+        ):
+            with self.assertRaises(RuntimeError):
+                call_command("update_index_products")
+
+            indexed_chunks.clear()
+            call_command("update_index_products", resume=True)
+
+        # The first chunk was not indexed again
+        self.assertEqual(indexed_chunks, [[4, 5], [6, 7]])
+        sleep(3)
+
+        _, total_hits = self.product_index.search()
+        self.assertEqual(total_hits, 6)
+        indices = ProductElasticsearchIndex().indexer.get_built_indices()
+        self.assertEqual(len(indices), 1)
+        self.assertIsNone(indices[0]["meta"]["completed_ranges"])
+
+    def test_reindex_keeps_indices_that_are_being_built(self):
+        other = ProductElasticsearchIndex().indexer
+        other.start()
+        self.addCleanup(other.delete, force_str(other.alias_name))
+
+        call_command("update_index_products")
+        names = [index["name"] for index in other.get_built_indices()]
+        self.assertIn(force_str(other.alias_name), names)
+
+        # Without progress for INDEXING_STALE_TIMEOUT it was abandoned
+        with patch("oscar_elasticsearch.search.settings.INDEXING_STALE_TIMEOUT", 0):
+            call_command("update_index_products")
+        names = [index["name"] for index in other.get_built_indices()]
+        self.assertNotIn(force_str(other.alias_name), names)
+
+    def test_resume_refuses_index_with_another_definition(self):
+        unfinished = ProductElasticsearchIndex().indexer
+        unfinished.start()
+        self.addCleanup(unfinished.delete, force_str(unfinished.alias_name))
+
+        indexer = ProductElasticsearchIndex().indexer
+        with patch(
+            "oscar_elasticsearch.search.settings.INDEXING_STALE_TIMEOUT", 0
+        ), patch.object(indexer, "get_definition_fingerprint", return_value="changed"):
+            self.assertFalse(indexer.resume())
+
+        with patch("oscar_elasticsearch.search.settings.INDEXING_STALE_TIMEOUT", 0):
+            self.assertTrue(indexer.resume())
+        self.assertEqual(indexer.alias_name, force_str(unfinished.alias_name))
+
+    def test_resume_skips_index_that_is_being_built(self):
+        unfinished = ProductElasticsearchIndex().indexer
+        unfinished.start()
+        self.addCleanup(unfinished.delete, force_str(unfinished.alias_name))
+
+        # It made progress within INDEXING_STALE_TIMEOUT
+        self.assertFalse(ProductElasticsearchIndex().indexer.resume())
+
+    @patch("oscar_elasticsearch.search.settings.INDEXING_CHECKPOINT_INTERVAL", 3600)
+    def test_completed_ranges_are_saved_periodically(self):
+        indexer = ProductElasticsearchIndex().indexer
+        indexer.start()
+        self.addCleanup(indexer.delete, force_str(indexer.alias_name))
+
+        indexer.add_completed_range(1, 2)
+        indexer.add_completed_range(3, 4)
+        self.assertEqual(indexer.get_meta(indexer.alias_name)["completed_ranges"], [])
+        self.assertEqual(indexer.get_completed_ranges(), [[1, 4]])
+
+        indexer.save_completed_ranges()
+        self.assertEqual(
+            indexer.get_meta(indexer.alias_name)["completed_ranges"], [[1, 4]]
+        )
+
+    def test_updates_during_reindex_are_kept(self):
+        call_command("update_index_products")
+
+        with ProductElasticsearchIndex().reindex() as index:
+            Product.objects.filter(pk=3).update(title="Hubble Photo Deluxe")
+            ProductElasticsearchIndex().update_or_create(Product.objects.filter(pk=3))
+
+            # The rebuild read the product before it was changed
+            Product.objects.filter(pk=3).update(title="Hubble Photo")
+            index.reindex_objects(Product.objects.all())
+
+        titles = ProductElasticsearchIndex().indexer.get_source_field(["3"], "title")
+        self.assertEqual(titles, {"3": "Hubble Photo Deluxe"})
+
+    def test_alias_lookups_are_cached(self):
+        with patch.object(
+            es.indices, "get_alias", wraps=es.indices.get_alias
+        ) as get_alias:
+            ProductElasticsearchIndex().update_or_create(Product.objects.all())
+            ProductElasticsearchIndex().update_or_create(Product.objects.all())
+
+        # Once for the live index and once for the indices being rebuilt
+        self.assertEqual(get_alias.call_count, 2)
+
+    def test_update_index_registered_concurrency(self):
+        from oscar_elasticsearch.search.management.commands.update_index_registered import (
+            Command,
+        )
+
+        class Lookup:
+            INDEXING_DEPENDENCIES = []
+
+        class Dependent:
+            INDEXING_DEPENDENCIES = [Lookup]
+
+        class Other:
+            INDEXING_DEPENDENCIES = []
+
+        events = []
+
+        def rebuild_index(Index):
+            events.append(("start", Index))
+            sleep(0.2)
+            events.append(("finish", Index))
+
+        command = Command(stdout=StringIO(), stderr=StringIO())
+        with patch.object(command, "rebuild_index_in_thread", rebuild_index):
+            failed = command.rebuild_indexes([Dependent, Lookup, Other], 2)
+
+        self.assertEqual(failed, [])
+        # Independent indexes are rebuilt at the same time, Dependent waits for
+        # Lookup to finish.
+        self.assertEqual(set(events[:2]), {("start", Lookup), ("start", Other)})
+        self.assertLess(
+            events.index(("finish", Lookup)), events.index(("start", Dependent))
+        )
+
+    def test_update_index_registered_failure_traceback(self):
+        from oscar_elasticsearch.search.management.commands.update_index_registered import (
+            Command,
+        )
+
+        class Broken:
+            INDEXING_DEPENDENCIES = []
+
+        def rebuild_index(Index):
+            raise RuntimeError("Elasticsearch is down")
+
+        for concurrency in [1, 2]:
+            stderr = StringIO()
+            command = Command(stdout=StringIO(), stderr=stderr)
+            with patch.object(command, "rebuild_index", rebuild_index):
+                failed = command.rebuild_indexes([Broken], concurrency)
+
+            self.assertEqual(failed, [Broken])
+            self.assertIn("Rebuilding Broken failed:", stderr.getvalue())
+            self.assertIn("Traceback (most recent call last):", stderr.getvalue())
+            self.assertIn("in rebuild_index", stderr.getvalue())
+            self.assertIn("RuntimeError: Elasticsearch is down", stderr.getvalue())
+
+    def test_update_index_registered_without_concurrency_uses_no_threads(self):
+        from oscar_elasticsearch.search.management.commands.update_index_registered import (
+            Command,
+        )
+
+        class Index:
+            INDEXING_DEPENDENCIES = []
+
+        command = Command(stdout=StringIO(), stderr=StringIO())
+        with patch.object(command, "rebuild_index") as rebuild_index, patch(
+            "oscar_elasticsearch.search.management.commands.update_index_registered.ThreadPoolExecutor"
+        ) as executor:
+            failed = command.rebuild_indexes([Index], 1)
+
+        self.assertEqual(failed, [])
+        rebuild_index.assert_called_once_with(Index)
+        executor.assert_not_called()
+
+    def test_update_index_registered_workers(self):
+        from oscar_elasticsearch.search.management.commands.update_index_registered import (
+            Command,
+        )
+
+        indexers = set()
+
+        class Index:
+            INDEXING_WORKERS = 2
+
+            def __init__(self):
+                self.indexer = Mock()
+                self.indexer.copy.side_effect = Mock
+
+            def reindex_objects(self, chunk):
+                indexers.add(self.indexer)
+                return len(chunk), []
+
+        read_chunks = []
+
+        def chunks():
+            for pk in range(20):
+                read_chunks.append(pk)
+                yield [pk]
+
+        index = Index()
+        results = Command().reindex_chunks(index, chunks())
+        first = next(results)
+
+        # The chunks are not all read up front
+        self.assertLessEqual(len(read_chunks), 2 * Index.INDEXING_WORKERS)
+        self.assertEqual([first] + list(results), [(1, [])] * 20)
+        # Every thread has its own indexer
+        self.assertNotIn(index.indexer, indexers)
+        self.assertLessEqual(len(indexers), Index.INDEXING_WORKERS)
+
+    def test_bulk_load_settings_are_restored_before_alias_switch(self):
+        indexer = ProductElasticsearchIndex().indexer
+        settings = dict(
+            indexer.settings, **{"refresh_interval": "5s", "number_of_replicas": 2}
+        )
+        create, put_settings, put_alias = (
+            es.indices.create,
+            es.indices.put_settings,
+            es.indices.put_alias,
+        )
+        events = []
+
+        def record_create(**kwargs):
+            events.append(("create", kwargs["body"]["settings"]["index"]))
+            return create(**kwargs)
+
+        def record_put_settings(**kwargs):
+            events.append(("settings", kwargs["settings"]["index"]))
+            return put_settings(**kwargs)
+
+        def record_put_alias(**kwargs):
+            events.append(("alias", kwargs["name"]))
+            return put_alias(**kwargs)
+
+        with patch.object(
+            ProductElasticsearchIndex, "get_index_settings", return_value=settings
+        ), patch.object(es.indices, "create", record_create), patch.object(
+            es.indices, "put_settings", record_put_settings
+        ), patch.object(
+            es.indices, "put_alias", record_put_alias
+        ):
+            call_command("update_index_products")
+
+        (created,) = [event for event in events if event[0] == "create"]
+        self.assertEqual(created[1]["refresh_interval"], "-1")
+        self.assertEqual(created[1]["number_of_replicas"], 0)
+
+        restored = events.index(
+            (
+                "settings",
+                {
+                    "refresh_interval": "5s",
+                    "number_of_replicas": 2,
+                    "translog.durability": None,
+                },
+            )
+        )
+        self.assertLess(restored, events.index(("alias", indexer.name)))
+
+    def set_up_incremental_changes(self):
+        """
+        Mark the index as up to date until now, and change product 3, the stock
+        of product 4 and the child product 7 after that.
+        """
+        call_command("update_index_products")
+        indexed_until = timezone.now()
+        ProductElasticsearchIndex().set_indexed_until(indexed_until)
+
+        before, after = (
+            indexed_until - timedelta(days=1),
+            indexed_until + timedelta(seconds=1),
+        )
+        Product.objects.update(date_updated=before)
+        StockRecord.objects.update(date_updated=before)
+        Product.objects.filter(pk__in=[3, 7]).update(date_updated=after)
+        StockRecord.objects.filter(product_id=4).update(date_updated=after)
+        return indexed_until
+
+    def test_update_index_products_incremental(self):
+        indexed_until = self.set_up_incremental_changes()
+
+        with patch.object(
+            ProductElasticsearchIndex,
+            "update_or_create",
+            autospec=True,
+            side_effect=ProductElasticsearchIndex.update_or_create,
+        ) as update_or_create:
+            call_command("update_index_products", "--incremental", stdout=StringIO())
+
+        indexed = sorted(
+            pk
+            for call in update_or_create.call_args_list
+            for pk in call.args[1].values_list("pk", flat=True)
+        )
+        # The parent of the changed child is indexed too
+        self.assertEqual(indexed, [3, 4, 6, 7])
+        self.assertGreater(
+            ProductElasticsearchIndex().get_indexed_until(), indexed_until
+        )
+
+    def test_update_index_products_incremental_errors_keep_mark(self):
+        indexed_until = self.set_up_incremental_changes()
+
+        with patch.object(
+            ProductElasticsearchIndex,
+            "update_or_create",
+            return_value=(0, [{"index": {"_id": "3", "status": 400}}]),
+        ):
+            call_command(
+                "update_index_products",
+                "--incremental",
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+
+        # The next run indexes the changed products again
+        self.assertEqual(ProductElasticsearchIndex().get_indexed_until(), indexed_until)
+
+    def test_update_index_products_if_changed(self):
+        indexer = ProductElasticsearchIndex().indexer
+        live_index = indexer.get_current_alias()
+
+        call_command("update_index_products", "--if-changed")
+        self.assertEqual(
+            ProductElasticsearchIndex().indexer.get_current_alias(), live_index
+        )
+
+        settings = dict(indexer.settings, **{"index.max_result_window": 20000})
+        with patch.object(
+            ProductElasticsearchIndex, "get_index_settings", return_value=settings
+        ):
+            self.assertEqual(
+                ProductElasticsearchIndex().indexer.get_definition_changes(),
+                indexer.DEFINITION_SETTINGS_CHANGED,
+            )
+            call_command("update_index_products", "--if-changed")
+            self.assertEqual(
+                ProductElasticsearchIndex().indexer.get_definition_changes(),
+                indexer.DEFINITION_UNCHANGED,
+            )
+        self.assertEqual(
+            ProductElasticsearchIndex().indexer.get_current_alias(), live_index
+        )
+
+        mappings = dict(indexer.mappings, dynamic=False)
+        with patch.object(
+            ProductElasticsearchIndex, "get_index_mapping", return_value=mappings
+        ):
+            call_command("update_index_products", "--if-changed")
+            self.assertNotEqual(
+                ProductElasticsearchIndex().indexer.get_current_alias(), live_index
+            )
+
+    def test_update_index_categories_if_changed_deletes_categories(self):
+        call_command("update_index_categories")
+        indexer = CategoryElasticsearchIndex().indexer
+        live_index = indexer.get_current_alias()
+        # A category that was deleted after the index was built
+        es.index(index=live_index, id="999", document={"name": "Gone"}, refresh=True)
+
+        call_command("update_index_categories", "--if-changed")
+        es.indices.refresh(index=live_index)
+
+        self.assertEqual(indexer.get_current_alias(), live_index)
+        self.assertEqual(indexer.get_all_ids(), {"1", "2"})
+
+    @patch("oscar_elasticsearch.search.settings.INDEXING_BULK_INITIAL_BACKOFF", 0)
+    def test_rejected_documents_are_retried(self):
+        def reject_first_attempt(_client, actions, **kwargs):
+            for action in actions:
+                if bulk.call_count == 1:
+                    yield False, {"index": {"_id": action["_id"], "status": 429}}
+                else:
+                    yield True, {"index": {"_id": action["_id"], "status": 201}}
+
+        with patch(
+            "oscar_elasticsearch.search.indexing.indexer.streaming_bulk",
+            side_effect=reject_first_attempt,
+        ) as bulk:
+            num_success, errors = ProductElasticsearchIndex().indexer.bulk(
+                {"_index": "test", "_id": _id} for _id in range(3)
+            )
+
+        self.assertEqual(bulk.call_count, 2)
+        self.assertEqual(num_success, 3)
+        self.assertEqual(errors, [])
+
+    @patch("oscar_elasticsearch.search.settings.INDEXING_BULK_INITIAL_BACKOFF", 0)
+    def test_rejected_requests_are_retried(self):
+        rejected = ApiError(
+            "es_rejected_execution_exception",
+            ApiResponseMeta(
+                status=429,
+                http_version="1.1",
+                headers=HttpHeaders(),
+                duration=0.0,
+                node=NodeConfig("http", "localhost", 9200),
+            ),
+            {},
+        )
+
+        def reject_second_request(_client, actions, **kwargs):
+            for action in actions:
+                if bulk.call_count == 1 and action["_id"] == 1:
+                    raise rejected
+                yield True, {"index": {"_id": action["_id"], "status": 201}}
+
+        with patch(
+            "oscar_elasticsearch.search.indexing.indexer.streaming_bulk",
+            side_effect=reject_second_request,
+        ) as bulk:
+            num_success, errors = ProductElasticsearchIndex().indexer.bulk(
+                {"_index": "test", "_id": _id} for _id in range(3)
+            )
+
+        self.assertEqual(bulk.call_count, 2)
+        # Only the actions that were not answered are sent again
+        self.assertEqual([action["_id"] for action in bulk.call_args.args[1]], [1, 2])
+        self.assertEqual(num_success, 3)
+        self.assertEqual(errors, [])
+
+    def test_update_or_create_skips_unchanged_products(self):
+        call_command("update_index_products")
+
+        num_indexed, errors = ProductElasticsearchIndex().update_or_create(
+            Product.objects.all()
+        )
+        self.assertEqual(num_indexed, 0)
+        self.assertEqual(errors, [])
+
+        Product.objects.filter(pk=3).update(title="Hubble Photo Deluxe")
+
+        num_indexed, errors = ProductElasticsearchIndex().update_or_create(
+            Product.objects.all()
+        )
+        self.assertEqual(num_indexed, 1)
+        self.assertEqual(errors, [])
+
+    def test_deleted_products_are_removed_from_index(self):
+        call_command("update_index_products")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk__in=[3, 4]).delete()
+        sleep(3)
+
+        _, total_hits = self.product_index.search()
+        self.assertEqual(total_hits, 4)
+        self.assertEqual(ProductElasticsearchIndex().delete_objects(["3"]), (0, []))
+
+    def test_update_stock(self):
+        ProductElasticsearchIndex().update_or_create(Product.objects.exclude(pk=4))
+
+        num_updated, errors = ProductElasticsearchIndex().update_stock(
+            Product.objects.filter(pk__in=[3, 4])
+        )
+        self.assertEqual(num_updated, 2)
+        self.assertEqual(errors, [])
+        sleep(3)
+
+        _, total_hits = self.product_index.search()
+        self.assertEqual(total_hits, 6)
+
+    def test_update_stock_indexes_missing_products_in_rebuilding_index(self):
+        ProductElasticsearchIndex().update_or_create(Product.objects.all())
+
+        with ProductElasticsearchIndex().reindex() as index:
+            num_updated, errors = ProductElasticsearchIndex().update_stock(
+                Product.objects.filter(pk=3)
+            )
+            self.assertEqual(errors, [])
+            # The partial update of the live index, and the complete document in
+            # the live index and the rebuilding index.
+            self.assertEqual(num_updated, 3)
+
+            # The rebuild did not add the product yet, so the complete document
+            # is sent instead of the partial update.
+            document = es.get(index=force_str(index.indexer.alias_name), id=3)
+            self.assertEqual(document["_source"]["id"], 3)
+            self.assertIn("title", document["_source"])
+
+    def test_updates_are_not_written_to_cached_deleted_index(self):
+        index = ProductElasticsearchIndex()
+        old_index = index.indexer.get_current_alias()
+        new_index = "%s_replaced" % index.indexer.name
+
+        # Another process replaces the live index, while this one still has the
+        # old index name cached.
+        es.indices.create(index=new_index)
+        es.indices.put_alias(index=new_index, name=index.indexer.name)
+        es.indices.delete(index=old_index)
+
+        num_indexed, errors = index.update_or_create(Product.objects.filter(pk=3))
+        self.assertEqual((num_indexed, errors), (1, []))
+        self.assertFalse(es.indices.exists(index=old_index))
+        self.assertTrue(es.get(index=new_index, id=3)["found"])
+
+    def test_update_index_categories_updates_product_categories(self):
+        call_command("update_index_products")
+        Category.objects.filter(pk=1).update(name="Walking goods")
+
+        update_index_categories([1])
+        sleep(3)
+
+        results, _ = self.product_index.search(raw_results=True)
+        categories = [
+            category
+            for hit in results["hits"]["hits"]
+            for category in hit["_source"]["categories"]
+        ]
+        self.assertTrue(categories)
+        for category in categories:
+            if category["id"] == 1:
+                self.assertEqual(category["name"], "Walking goods")
+            else:
+                self.assertEqual(category["ancestor_names"], "Walking goods")
+
+    def test_update_index_categories_removes_hidden_categories(self):
+        call_command("update_index_products")
+        Category.objects.filter(pk=1).update(is_public=False)
+        Category.objects.filter(pk=2).update(ancestors_are_public=False)
+
+        with patch.object(es, "update_by_query", wraps=es.update_by_query) as update:
+            update_index_categories([1])
+
+        params = update.call_args.kwargs["script"]["params"]
+        self.assertEqual(sorted(params["deleted_ids"]), ["1", "2"])
+        self.assertEqual(params["categories"], {})
+
+    def test_update_index_categories_indexes_products_of_browsable_categories(self):
+        Category.objects.filter(pk=2).update(is_public=False)
+        call_command("update_index_products")
+        Category.objects.filter(pk=2).update(is_public=True)
+
+        # None of the indexed products has an entry for category 2 yet
+        with patch(
+            "oscar_elasticsearch.search.api.product.scan", return_value=iter([])
+        ), patch.object(ProductElasticsearchIndex, "update_or_create") as update:
+            update_index_categories([2])
+
+        indexed = sorted(
+            pk
+            for call in update.call_args_list
+            for pk in call.args[0].values_list("pk", flat=True)
+        )
+        # Child products get the categories of their parent
+        self.assertEqual(indexed, [4, 5, 6, 7])
+        self.assertEqual(Product.objects.get(pk=7).parent_id, 6)
+
+    def test_search_index_worker(self):
+        add_to_outbox(OutboxEntry.PRODUCT, Product.objects.values_list("pk", flat=True))
+        add_to_outbox(
+            OutboxEntry.CATEGORY, Category.objects.values_list("pk", flat=True)
+        )
+
+        call_command("search_index_worker", once=True)
+        sleep(3)
+
+        self.assertFalse(OutboxEntry.objects.exists())
+        _, total_hits = self.product_index.search()
+        self.assertEqual(total_hits, 6)
+        _, total_hits = self.category_index.search()
+        self.assertEqual(total_hits, 2)
+
+    def test_search_index_worker_keeps_failed_entries(self):
+        add_to_outbox(OutboxEntry.PRODUCT, [1, 2])
+
+        with patch(
+            "oscar_elasticsearch.search.outbox.update_index_products",
+            side_effect=Exception("Elasticsearch is down"),
+        ):
+            call_command("search_index_worker", once=True, max_attempts=2)
+
+        self.assertEqual(
+            list(OutboxEntry.objects.values_list("object_id", "attempts")),
+            [("1", 2), ("2", 2)],
+        )
+
     def test_parent_child_attributes_merging(self):
         parent = Product.objects.get(pk=6)
         child = Product.objects.get(pk=7)
@@ -377,3 +1115,296 @@ class TestBrowsableItems(TestCase):
 
         self.assertEqual(len(products), 2)
         self.assertFalse(any([product.structure == "child" for product in products]))
+
+
+class ChunkedQuerysetTestCase(TestCase):
+    fixtures = [
+        "search/auth",
+        "catalogue/catalogue",
+    ]
+
+    def test_chunks_cover_queryset_in_pk_order(self):
+        chunks = [
+            list(chunk.values_list("pk", flat=True))
+            for chunk in chunked_queryset(Product.objects.all(), 4)
+        ]
+
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 2])
+        self.assertEqual(
+            sum(chunks, []),
+            list(Product.objects.order_by("pk").values_list("pk", flat=True)),
+        )
+
+    def test_chunks_do_not_use_offset(self):
+        with CaptureQueriesContext(connection) as queries:
+            for chunk in chunked_queryset(Product.objects.all(), 1):
+                list(chunk)
+
+        self.assertFalse(
+            any("OFFSET" in query["sql"] for query in queries.captured_queries)
+        )
+
+
+class ProductStockDocumentsTestCase(TestCase):
+    fixtures = [
+        "search/auth",
+        "catalogue/catalogue",
+    ]
+
+    def test_stock_documents_match_complete_documents(self):
+        index = ProductElasticsearchIndex()
+        documents = {
+            document["_id"]: document["_source"]
+            for document in index.make_documents(Product.objects.all())
+        }
+
+        stock_documents = list(index.make_stock_documents(Product.objects.all()))
+        self.assertEqual(len(stock_documents), len(documents))
+        for stock_document in stock_documents:
+            source = documents[stock_document["_id"]]
+            for field, value in stock_document["doc"].items():
+                if field != index.FINGERPRINT_FIELD:
+                    self.assertEqual(source[field], value, field)
+
+    def test_stock_documents_round_prices_like_complete_documents(self):
+        FixedPrice = get_class("partner.prices", "FixedPrice")
+        # A price with sales tax added, which has more than 2 decimal places
+        with_tax = property(lambda price: price.excl_tax * Decimal("1.0725"))
+
+        index = ProductElasticsearchIndex()
+        with patch.object(FixedPrice, "incl_tax", with_tax):
+            documents = {
+                document["_id"]: document["_source"]
+                for document in index.make_documents(Product.objects.all())
+            }
+            fast_documents = {
+                document["_id"]: document["_source"]
+                for document in index.make_fast_documents(Product.objects.all())
+            }
+            stock_documents = list(index.make_stock_documents(Product.objects.all()))
+
+        self.assertEqual(documents[3]["price"], "24.67")
+        for stock_document in stock_documents:
+            price = stock_document["doc"]["price"]
+            self.assertEqual(documents[stock_document["_id"]]["price"], price)
+            self.assertEqual(fast_documents[stock_document["_id"]]["price"], price)
+
+
+class FastProductDocumentsTestCase(TestCase):
+    fixtures = [
+        "search/auth",
+        "catalogue/catalogue",
+    ]
+
+    def test_fast_documents_match_odin_documents(self):
+        # The image file is written to MEDIA_ROOT
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+
+        with override_settings(MEDIA_ROOT=media_root):
+            parent = Product.objects.filter(structure=Product.PARENT).first()
+            ProductImageFactory(product=parent)
+
+            index = ProductElasticsearchIndex()
+            products = Product.objects.all()
+            documents = index.dump_documents(
+                index.map_product_resources(index.make_product_resources(products))
+            )
+            fast_documents = index.make_fast_documents(products)
+
+        self.assertEqual(
+            sorted(documents, key=lambda document: document["_id"]),
+            sorted(fast_documents, key=lambda document: document["_id"]),
+        )
+
+    def test_attribute_values_by_product(self):
+        get_attribute_values_by_product = get_class(
+            "search.mappings.products.mappings", "get_attribute_values_by_product"
+        )
+        ProductToResource = get_class(
+            "oscar_odin.mappings.catalogue", "ProductToResource"
+        )
+        # pylint: disable=protected-access
+        to_native_type = ProductToResource._attribute_value_to_native_type
+        products = list(Product.objects.all())
+
+        with self.assertNumQueries(2):
+            attribute_values = get_attribute_values_by_product(
+                {product.id: product.parent_id for product in products}
+            )
+
+        for product in products:
+            self.assertEqual(
+                attribute_values[product.id],
+                {
+                    item.attribute.code: to_native_type(item)
+                    for item in product.get_attribute_values()
+                },
+            )
+
+
+class LookupIndexTestCase(TestCase):
+    fixtures = [
+        "search/auth",
+        "catalogue/catalogue",
+    ]
+
+    def test_lookup_documents_are_built_with_a_single_query(self):
+        from assortment.index import UserProductAssortmentIndex
+        from assortment.models import AssortmentProduct, AssortmentUser
+
+        first, second = User.objects.order_by("pk")[:2]
+        assortment_user = AssortmentUser.objects.create(user=first)
+        for product in Product.objects.filter(pk__in=[3, 2]):
+            AssortmentProduct.objects.create(
+                assortment_user=assortment_user, product=product
+            )
+        AssortmentUser.objects.create(user=second)
+
+        index = UserProductAssortmentIndex()
+        with self.assertNumQueries(1):
+            documents = list(index.make_documents(AssortmentUser.objects.all()))
+
+        self.assertEqual(
+            documents,
+            [
+                {"_id": first.id, "_source": {"product_ids": [2, 3]}},
+                {"_id": second.id, "_source": {"product_ids": []}},
+            ],
+        )
+
+
+class CategoryContextTestCase(TestCase):
+    fixtures = [
+        "search/auth",
+        "catalogue/catalogue",
+    ]
+
+    def test_category_context_is_rebuilt_when_version_is_bumped(self):
+        index = ProductElasticsearchIndex()
+        index.update_category_context()
+        Category.objects.filter(pk=1).update(name="Walking goods")
+
+        with self.assertNumQueries(0):
+            index.update_category_context()
+        self.assertEqual(index.context["category_titles"][1], "Ambulant goods")
+
+        bump_category_tree_version()
+        index.update_category_context()
+        self.assertEqual(index.context["category_titles"][1], "Walking goods")
+
+
+class UpdateIndexTransactionTestCase(TestCase):
+    fixtures = [
+        "search/auth",
+        "catalogue/catalogue",
+    ]
+
+    @patch("oscar_elasticsearch.search.update.update_index_categories")
+    @patch("oscar_elasticsearch.search.update.update_index_products")
+    def test_changes_are_indexed_once_on_commit(self, mock_update_index_products, _):
+        with self.captureOnCommitCallbacks(execute=True):
+            for product in Product.objects.filter(pk__in=[3, 4]):
+                product.save()
+                product.save()
+
+            mock_update_index_products.assert_not_called()
+
+        mock_update_index_products.assert_called_once()
+        self.assertEqual(
+            sorted(mock_update_index_products.call_args.args[0]), ["3", "4"]
+        )
+
+    @patch("oscar_elasticsearch.search.update.delete_products", return_value=[])
+    @patch(
+        "oscar_elasticsearch.search.update.update_index_product_stock",
+        return_value=[],
+    )
+    @patch("oscar_elasticsearch.search.update.update_index_categories", return_value=[])
+    @patch("oscar_elasticsearch.search.update.update_index_products")
+    def test_indexing_errors_are_logged(self, mock_update_index_products, *_):
+        error = {"index": {"_id": "3", "status": 400}}
+        mock_update_index_products.return_value = [error]
+
+        with self.assertLogs("oscar_elasticsearch.search.update", "ERROR") as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.get(pk=3).save()
+
+        self.assertIn("1 documents could not be indexed", logs.output[0])
+        self.assertIn(str(error), logs.output[0])
+
+    @patch("oscar_elasticsearch.search.update.update_index_categories")
+    @patch("oscar_elasticsearch.search.update.update_index_products")
+    def test_rolled_back_changes_are_not_indexed(self, mock_update_index_products, _):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Product.objects.get(pk=3).save()
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+
+            Product.objects.get(pk=4).save()
+
+        mock_update_index_products.assert_called_once_with(["4"])
+
+    @patch("oscar_elasticsearch.search.update.delete_products")
+    @patch("oscar_elasticsearch.search.update.update_index_product_stock")
+    @patch("oscar_elasticsearch.search.update.update_index_categories")
+    @patch("oscar_elasticsearch.search.update.update_index_products")
+    def test_rolled_back_savepoint_after_push_is_not_indexed(
+        self, mock_update_index_products, _, __, delete_products
+    ):
+        UpdateIndex = get_class("search.update", "UpdateIndex")
+        update_index = UpdateIndex()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                update_index.push_product("4")
+                try:
+                    with transaction.atomic():
+                        update_index.push_product("3")
+                        update_index.push_product_delete("9")
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+
+                with transaction.atomic():
+                    update_index.push_product("5")
+
+                # The released savepoint is merged into the transaction
+                update_index.push_product("6")
+
+        mock_update_index_products.assert_called_once()
+        self.assertEqual(
+            sorted(mock_update_index_products.call_args.args[0]), ["4", "5", "6"]
+        )
+        delete_products.assert_called_once_with([])
+
+    @patch("oscar_elasticsearch.search.update.update_index_categories")
+    @patch("oscar_elasticsearch.search.update.update_index_products")
+    def test_released_savepoint_is_indexed_with_transaction(
+        self, mock_update_index_products, _
+    ):
+        UpdateIndex = get_class("search.update", "UpdateIndex")
+        update_index = UpdateIndex()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                update_index.push_product("4")
+                with transaction.atomic():
+                    update_index.push_product("5")
+
+                # Rolled back after the last push
+                try:
+                    with transaction.atomic():
+                        with transaction.atomic():
+                            update_index.push_product("3")
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+
+        mock_update_index_products.assert_called_once()
+        self.assertEqual(
+            sorted(mock_update_index_products.call_args.args[0]), ["4", "5"]
+        )
@@ -1,28 +1,183 @@
+import logging
 import threading
-from oscar.core.loading import get_classes
+from functools import partial
 
-update_index_products, update_index_categories = get_classes(
-    "search.helpers", ["update_index_products", "update_index_categories"]
+from django.db import transaction
+
+from oscar.core.loading import get_class, get_classes, get_model
+
+from oscar_elasticsearch.search import settings
+
+(
+    update_index_products,
+    update_index_categories,
+    update_index_product_stock,
+    delete_products,
+) = get_classes(
+    "search.helpers",
+    [
+        "update_index_products",
+        "update_index_categories",
+        "update_index_product_stock",
+        "delete_products",
+    ],
 )
+add_to_outbox = get_class("search.outbox", "add_to_outbox")
+OutboxEntry = get_model("search", "OutboxEntry")
+
+logger = logging.getLogger(__name__)
+
+
+# Django has no public API to find out which on_commit callbacks are still
+# registered, or to change the order they run in. These rely on
+# connection.run_on_commit holding (savepoint_ids, func, robust) tuples, like
+# UpdateIndex.get_pending relies on connection.savepoint_ids. The CI runs the
+# tests on every supported Django version.
+def get_on_commit_callbacks(connection):
+    return [callback[1] for callback in connection.run_on_commit]
+
+
+def move_on_commit_to_end(connection, func):
+    """
+    Make the on_commit callback func run after the callbacks registered since.
+    It is still forgotten when the savepoint it was registered in is rolled back.
+    """
+    for callback in connection.run_on_commit:
+        if callback[1] is func:
+            connection.run_on_commit.remove(callback)
+            connection.run_on_commit.append(callback)
+            return
+
+
+def merge_pending(pending, other):
+    for object_type, object_ids in other.items():
+        pending[object_type].update(object_ids)
 
 
 class UpdateIndex(threading.local):
+    """
+    Collects the products and categories that must be reindexed, and the
+    products that must be removed from the index.
+
+    Changes made in a transaction are indexed in one batch when the transaction
+    is committed, and dropped when it is rolled back. Changes made outside of a
+    transaction are indexed when the request is finished.
+    """
+
     def __init__(self):
         super().__init__()
-        self._products = set()
-        self._categories = set()
+        self._pending = self.get_empty_pending()
+        # The pending ids of the current transaction, see start_transaction
+        self._transaction = None
+
+    def get_empty_pending(self):
+        return {
+            OutboxEntry.PRODUCT: set(),
+            OutboxEntry.CATEGORY: set(),
+            OutboxEntry.PRODUCT_STOCK: set(),
+            OutboxEntry.PRODUCT_DELETE: set(),
+        }
 
     def push_category(self, *categories):
-        self._categories.update(categories)
+        self._push(OutboxEntry.CATEGORY, categories)
 
     def push_product(self, *products):
-        self._products.update(products)
+        self._push(OutboxEntry.PRODUCT, products)
+
+    def push_product_stock(self, *products):
+        self._push(OutboxEntry.PRODUCT_STOCK, products)
+
+    def push_product_delete(self, *products):
+        self._push(OutboxEntry.PRODUCT_DELETE, products)
+
+    def _push(self, object_type, object_ids):
+        pending = self.get_pending()[object_type]
+        object_ids = set(object_ids) - pending
+        pending.update(object_ids)
+
+        # Inside a transaction the outbox entries are written right away, so
+        # they are committed or rolled back together with the change itself.
+        if settings.USE_OUTBOX and transaction.get_connection().in_atomic_block:
+            add_to_outbox(object_type, object_ids)
+
+    def get_pending(self):
+        """
+        Returns the pending ids per object type of the current savepoint or
+        transaction, or of the request when not inside a transaction.
+        """
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            return self._pending
+
+        # The callback is gone when the transaction that registered it ended, or
+        # when the savepoint it was registered in was rolled back, together with
+        # everything pushed since.
+        if self._transaction is None or self._transaction[
+            "on_commit"
+        ] not in get_on_commit_callbacks(connection):
+            self._transaction = self.start_transaction()
+
+        # Atomic blocks without a savepoint are rolled back with the enclosing one
+        current = tuple(sid for sid in connection.savepoint_ids if sid is not None)
+        savepoints = self._transaction["savepoints"]
+        if current not in savepoints:
+            savepoints[current] = self.get_empty_pending()
+            # Django forgets this callback when the savepoint is rolled back, so
+            # only the ids of savepoints that were kept are merged.
+            transaction.on_commit(
+                partial(
+                    merge_pending, self._transaction["pending"], savepoints[current]
+                )
+            )
+            move_on_commit_to_end(connection, self._transaction["on_commit"])
+
+        return savepoints[current]
+
+    def start_transaction(self):
+        """
+        Collects the pending ids of an outermost atomic block, they are indexed
+        in one batch after the callbacks of its savepoints merged their ids.
+        """
+        state = {"pending": self.get_empty_pending(), "savepoints": {}}
+
+        def on_commit():
+            if self._transaction is state:
+                self._transaction = None
+            if not settings.USE_OUTBOX and any(state["pending"].values()):
+                self.update_index(state["pending"])
+
+        state["on_commit"] = on_commit
+        transaction.on_commit(on_commit)
+        return state
+
+    def update_index(self, pending):
+        products = pending[OutboxEntry.PRODUCT]
+        errors = update_index_products(list(products))
+        errors += update_index_categories(list(pending[OutboxEntry.CATEGORY]))
+        # Products that are updated completely already have the new stock.
+        errors += update_index_product_stock(
+            list(pending[OutboxEntry.PRODUCT_STOCK] - products)
+        )
+        errors += delete_products(list(pending[OutboxEntry.PRODUCT_DELETE]))
+
+        # The change itself is already saved, without an outbox to retry the
+        # indexing later the errors can only be reported.
+        if errors:
+            logger.error(
+                "%i documents could not be indexed, the first error was: %s",
+                len(errors),
+                errors[0],
+            )
 
     # pylint: disable=unused-argument
     def synchronize_searchindex(self, **kwargs):
-        categories = list(self._categories)
-        self._categories = set()
-        products = list(self._products)
-        self._products = set()
-        update_index_products(products)
-        update_index_categories(categories)
+        pending = self._pending
+        self._pending = self.get_empty_pending()
+
+        # With the outbox the indexing is left to the search_index_worker
+        # management command, so the request doesn't have to wait for it.
+        if settings.USE_OUTBOX:
+            for object_type, object_ids in pending.items():
+                add_to_outbox(object_type, object_ids)
+        else:
+            self.update_index(pending)
@@ -1,7 +1,17 @@
+import hashlib
+import json
 from collections import defaultdict
 
-from django.db import connection
+from django.core.cache import caches
 from django.db.models import Case, When
+from django.utils.crypto import get_random_string
+
+from oscar.core.loading import get_model
+
+from oscar_elasticsearch.search import settings
+
+CATEGORY_TREE_VERSION_KEY = "oscar_elasticsearch:category_tree_version"
+CATEGORY_CONTEXT_KEY = "oscar_elasticsearch:category_context:%s"
 
 
 def chunked(iterable, size, startindex=0):
@@ -23,6 +33,131 @@ def chunked(iterable, size, startindex=0):
         startindex += size
 
 
+def chunked_pk_ranges(queryset, size):
+    """
+    Divide a queryset into chunks of ``size``, ordered by primary key, and yield
+    the first and last primary key of every chunk.
+
+    Instead of slicing with LIMIT/OFFSET, which gets slower the deeper into the
+    table a chunk is, every chunk continues after the last primary key of the
+    previous one.
+    """
+    queryset = queryset.order_by("pk")
+    last_pk = None
+    while True:
+        remaining = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(remaining.values_list("pk", flat=True)[:size])
+        if pks:
+            yield pks[0], pks[-1]
+        if len(pks) < size:
+            break
+        last_pk = pks[-1]
+
+
+def chunked_queryset(queryset, size):
+    """
+    Divide a queryset into chunks of ``size``, ordered by primary key, see
+    chunked_pk_ranges. The chunks are querysets themselves, so they can still be
+    annotated and prefetched.
+    """
+    queryset = queryset.order_by("pk")
+    for start_pk, end_pk in chunked_pk_ranges(queryset, size):
+        yield queryset.filter(pk__gte=start_pk, pk__lte=end_pk)
+
+
+def split_range(start, end, parts):
+    """
+    Divide the inclusive range ``start`` to ``end`` into at most ``parts``
+    contiguous inclusive ranges.
+
+    >>> list(split_range(1, 10, 3))
+    [(1, 4), (5, 8), (9, 10)]
+    >>> list(split_range(1, 2, 4))
+    [(1, 1), (2, 2)]
+    """
+    size = max(1, -(-(end - start + 1) // parts))
+    while start <= end:
+        yield start, min(start + size - 1, end)
+        start += size
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent inclusive ranges.
+
+    >>> merge_ranges([(5, 8), (1, 2), (3, 4), (10, 12), (11, 11)])
+    [[1, 8], [10, 12]]
+    >>> merge_ranges([])
+    []
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+class AdaptiveChunkSize(object):
+    """
+    A chunk size that follows how long it takes to process a chunk. It is halved
+    when a chunk took longer than ``target_seconds`` or was rejected, and grows by
+    a quarter when a full chunk took less than half of that time.
+
+    >>> chunk_size = AdaptiveChunkSize(400, 100, 1000, target_seconds=1.0)
+    >>> chunk_size.update(400, 0.2); chunk_size.size
+    500
+    >>> chunk_size.update(500, 3.0); chunk_size.size
+    250
+    >>> chunk_size.update(100, 0.1); chunk_size.size
+    250
+    >>> chunk_size.update(250, 0.1, rejected=True); chunk_size.size
+    125
+    """
+
+    def __init__(self, size, min_size, max_size, target_seconds=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(size, min_size), max_size)
+        self.target_seconds = target_seconds
+
+    def update(self, num_items, seconds, rejected=False):
+        if self.target_seconds is None:
+            return
+
+        if rejected or seconds > self.target_seconds:
+            self.size = max(self.min_size, self.size // 2)
+        # Smaller chunks than the current size are not representative
+        elif num_items >= self.size and seconds < self.target_seconds / 2:
+            self.size = min(self.max_size, self.size + max(1, self.size // 4))
+
+
+def get_document_fingerprint(source, exclude=()):
+    """
+    Returns a stable hash of the source of a document, ignoring the fields in
+    ``exclude``.
+
+    >>> get_document_fingerprint({"a": [1, 2], "b": "c"}) == get_document_fingerprint(
+    ...     {"b": "c", "a": [1, 2]}
+    ... )
+    True
+    >>> get_document_fingerprint({"a": 1, "b": 2}, exclude=["b"]) == get_document_fingerprint(
+    ...     {"a": 1, "b": 3}, exclude=["b"]
+    ... )
+    True
+    >>> get_document_fingerprint({"a": 1}) == get_document_fingerprint({"a": 2})
+    False
+    """
+    data = json.dumps(
+        {key: value for key, value in source.items() if key not in exclude},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
 def search_result_to_queryset(search_results, Model):
     instance_ids = [hit["_source"]["id"] for hit in search_results["hits"]["hits"]]
 
@@ -144,25 +279,74 @@ def get_index_settings(MAX_GRAM):
     }
 
 
+def get_ancestors_from_paths(rows, steplen):
+    """
+    Get a mapping of all child categories with all of its ancestor categories,
+    ordered from the root to the parent, from the ids and treebeard paths of the
+    categories.
+
+    >>> ancestors = get_ancestors_from_paths(
+    ...     [(3, "000100010001"), (1, "0001"), (2, "00010001"), (4, "0002")], 4
+    ... )
+    >>> dict(ancestors)
+    {3: [1, 2], 2: [1]}
+    """
+    ids_by_path = {path: category_id for category_id, path in rows}
+
+    category_ancestors = defaultdict(list)
+    for category_id, path in rows:
+        for depth in range(steplen, len(path), steplen):
+            ancestor_id = ids_by_path.get(path[:depth])
+            if ancestor_id is not None:
+                category_ancestors[category_id].append(ancestor_id)
+
+    return category_ancestors
+
+
 def get_category_ancestors():
     """
     Get a mapping of all child categories with all of its ancestor categories.
     {child_id: [ancestor1_id, ancestor2_id]}}
     """
-    query = """
-        SELECT 
-            child.id AS child_id,
-            parent.id AS up_id
-        FROM catalogue_category AS child
-        JOIN catalogue_category AS parent
-        ON child.path LIKE (parent.path || '%') AND child.id > parent.id;
+    Category = get_model("catalogue", "Category")
+    rows = list(Category.objects.values_list("id", "path"))
+    return get_ancestors_from_paths(rows, Category.steplen)
+
+
+def get_category_tree_version():
+    """
+    Returns the current version of the category tree, which changes every time
+    a category is changed.
     """
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        rows = cursor.fetchall()
+    return caches[settings.CATEGORY_CONTEXT_CACHE].get_or_set(
+        CATEGORY_TREE_VERSION_KEY, lambda: get_random_string(12), timeout=None
+    )
 
-    category_ancestors = defaultdict(list)
-    for child_id, ancestor_id in rows:
-        category_ancestors[child_id].append(ancestor_id)
 
-    return category_ancestors
+def bump_category_tree_version():
+    caches[settings.CATEGORY_CONTEXT_CACHE].set(
+        CATEGORY_TREE_VERSION_KEY, get_random_string(12), timeout=None
+    )
+
+
+def get_category_context(version):
+    """
+    Returns the category titles and ancestors needed to index products, for the
+    given version of the category tree. They are cached, so the category tree is
+    only read again after a category changed.
+    """
+    cache = caches[settings.CATEGORY_CONTEXT_CACHE]
+    context = cache.get(CATEGORY_CONTEXT_KEY % version)
+    if context is None:
+        Category = get_model("catalogue", "Category")
+        context = {
+            "category_titles": dict(Category.objects.values_list("id", "name")),
+            "category_ancestors": get_category_ancestors(),
+        }
+        cache.set(
+            CATEGORY_CONTEXT_KEY % version,
+            context,
+            settings.CATEGORY_CONTEXT_CACHE_TIMEOUT,
+        )
+
+    return context
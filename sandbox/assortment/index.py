@@ -15,21 +15,10 @@ from .models import AssortmentUser
 class UserProductAssortmentIndex(BaseLookupIndex):
     INDEX_NAME = "user_product_assortment"
     LOOKUP_PATH = "product_ids"
+    LOOKUP_OWNER_FIELD = "user_id"
+    LOOKUP_VALUE_FIELD = "products__product_id"
     Model = AssortmentUser
 
-    def make_documents(self, objects):
-        documents = []
-
-        for obj in objects:
-            documents.append(
-                {
-                    "_id": obj.user.id,
-                    self.LOOKUP_PATH: list(obj.products.all().values_list("product_id", flat=True))
-                }
-            )
-
-        return documents
-        
     def get_lookup_id(self, field_to_filter, **kwargs):
         request = kwargs.get("request", None)
         if request and request.user.is_authenticated:
@@ -0,0 +1,169 @@
+import json
+import time
+from contextlib import nullcontext
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.encoding import force_str
+
+from elastic_transport import ObjectApiResponse
+from oscar.core.loading import get_class, get_model
+
+from oscar_elasticsearch.search import settings
+
+chunked_queryset = get_class("search.utils", "chunked_queryset")
+ProductElasticsearchIndex = get_class("search.api.product", "ProductElasticsearchIndex")
+Product = get_model("catalogue", "Product")
+es = get_class("search.backend", "es")
+
+
+class Command(BaseCommand):
+    """
+    Measure how fast the product documents are built and indexed, per chunk of
+    products. By default the bulk requests are answered in-process as if every
+    document was indexed, so only the work done by this process is measured.
+    With --cluster the documents are indexed into a new index in the
+    elasticsearch of OSCAR_ELASTICSEARCH_SERVER_URLS, which is deleted afterwards.
+
+    Use generate_catalogue to create a catalogue to run it on.
+    """
+
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.INDEXING_CHUNK_SIZE,
+            help="Number of products per chunk",
+        )
+        parser.add_argument(
+            "--limit", type=int, help="Only use the first LIMIT products"
+        )
+        parser.add_argument(
+            "--skip-bulk",
+            action="store_true",
+            help="Only build the documents, without indexing them",
+        )
+        parser.add_argument(
+            "--cluster",
+            action="store_true",
+            help="Send the bulk requests to elasticsearch, instead of a stub",
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options["limit"]:
+            last_pk = (
+                products.order_by("pk")
+                .values_list("pk", flat=True)[options["limit"] - 1 : options["limit"]]
+                .first()
+            )
+            if last_pk is not None:
+                products = products.filter(pk__lte=last_pk)
+
+        index = ProductElasticsearchIndex()
+        indexer = index.indexer
+        index_name = force_str(indexer.alias_name)
+        use_cluster = options["cluster"] and not options["skip_bulk"]
+        if use_cluster:
+            indexer.create(index_name, indexer.get_bulk_load_settings())
+
+        # The class level context is shared by all instances
+        index.context = {**index.context, "popularity": index.get_popularity()}
+        totals = {"documents": 0, "queries": 0, "build": 0.0, "bulk": 0.0}
+        # The helpers send the requests with a copy of the client, so the class
+        # is patched.
+        stub = nullcontext() if use_cluster else patch.object(type(es), "bulk", bulk)
+        try:
+            with stub:
+                for number, chunk in enumerate(
+                    chunked_queryset(products, options["chunk_size"]), 1
+                ):
+                    self.benchmark_chunk(
+                        number, index, chunk, index_name, options["skip_bulk"], totals
+                    )
+        finally:
+            if use_cluster:
+                indexer.delete(index_name)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "\n%i documents, %i queries, built in %.2fs (%.0f docs/s), "
+                "indexed in %.2fs (%.0f docs/s), %.0f docs/s overall"
+                % (
+                    totals["documents"],
+                    totals["queries"],
+                    totals["build"],
+                    rate(totals["documents"], totals["build"]),
+                    totals["bulk"],
+                    rate(totals["documents"], totals["bulk"]),
+                    rate(totals["documents"], totals["build"] + totals["bulk"]),
+                )
+            )
+        )
+
+    def benchmark_chunk(self, number, index, chunk, index_name, skip_bulk, totals):
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            documents = list(index.make_documents(chunk))
+        build_duration = time.perf_counter() - started
+
+        bulk_duration = 0.0
+        errors = []
+        if not skip_bulk:
+            started = time.perf_counter()
+            _, errors = index.indexer.bulk_index(documents, index_name)
+            bulk_duration = time.perf_counter() - started
+
+        totals["documents"] += len(documents)
+        totals["queries"] += len(queries)
+        totals["build"] += build_duration
+        totals["bulk"] += bulk_duration
+
+        self.stdout.write(
+            "Chunk %i: %i documents, %i queries, built in %.3fs (%.0f docs/s), "
+            "indexed in %.3fs (%.0f docs/s)%s"
+            % (
+                number,
+                len(documents),
+                len(queries),
+                build_duration,
+                rate(len(documents), build_duration),
+                bulk_duration,
+                rate(len(documents), bulk_duration),
+                ", %i errors" % len(errors) if errors else "",
+            )
+        )
+
+
+def rate(num_documents, duration):
+    return num_documents / duration if duration else 0
+
+
+def bulk(_client, operations, **_kwargs):
+    """
+    Answers a bulk request like elasticsearch does when every action succeeded,
+    without sending it anywhere.
+    """
+    items = []
+    lines = iter(operations)
+    for line in lines:
+        ((op_type, action),) = json.loads(line).items()
+        if op_type != "delete":
+            next(lines)  # The document
+        items.append(
+            {
+                op_type: {
+                    "_index": action.get("_index"),
+                    "_id": action.get("_id"),
+                    "status": 201 if op_type == "create" else 200,
+                }
+            }
+        )
+
+    return ObjectApiResponse(
+        body={"took": 0, "errors": False, "items": items}, meta=None
+    )
@@ -0,0 +1,248 @@
+import random
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.crypto import get_random_string
+
+from oscar.core.loading import get_model
+from oscar.core.utils import slugify
+
+Category = get_model("catalogue", "Category")
+Partner = get_model("partner", "Partner")
+Product = get_model("catalogue", "Product")
+ProductAttribute = get_model("catalogue", "ProductAttribute")
+ProductAttributeValue = get_model("catalogue", "ProductAttributeValue")
+ProductCategory = get_model("catalogue", "ProductCategory")
+ProductClass = get_model("catalogue", "ProductClass")
+StockRecord = get_model("partner", "StockRecord")
+
+BATCH_SIZE = 1000
+WORDS = [
+    "alpine",
+    "bamboo",
+    "canvas",
+    "classic",
+    "cotton",
+    "denim",
+    "leather",
+    "linen",
+    "merino",
+    "outdoor",
+    "retro",
+    "summer",
+    "travel",
+    "urban",
+    "winter",
+    "wool",
+]
+
+
+class Command(BaseCommand):
+    """
+    Generate a synthetic catalogue to benchmark indexing with, see
+    benchmark_index_products.
+
+    Everything is created with bulk_create, so no signals are sent and nothing
+    is indexed while the catalogue is generated.
+    """
+
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=1000,
+            help="Number of standalone and parent products",
+        )
+        parser.add_argument(
+            "--parent-ratio",
+            type=float,
+            default=0.2,
+            help="Fraction of the products that are parent products",
+        )
+        parser.add_argument(
+            "--children",
+            type=int,
+            default=3,
+            help="Number of child products of every parent product",
+        )
+        parser.add_argument(
+            "--attributes",
+            type=int,
+            default=10,
+            help="Number of attributes with a value for every product",
+        )
+        parser.add_argument(
+            "--categories",
+            type=int,
+            default=50,
+            help="Number of categories, the products are divided over them",
+        )
+        parser.add_argument(
+            "--stockrecords",
+            type=int,
+            default=1,
+            help="Number of stock records of every standalone and child product",
+        )
+        parser.add_argument("--seed", type=int, help="Seed of the random generator")
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        # Makes the upcs and skus unique, so the command can be run repeatedly.
+        self.run_id = get_random_string(6).lower()
+
+        with transaction.atomic():
+            product_class, _ = ProductClass.objects.get_or_create(name="Benchmark")
+            attributes = self.create_attributes(product_class, options["attributes"])
+            categories = self.create_categories(options["categories"])
+
+            num_parents = int(options["products"] * options["parent_ratio"])
+            parents = self.create_products(
+                num_parents, structure=Product.PARENT, product_class=product_class
+            )
+            standalone_products = self.create_products(
+                options["products"] - num_parents,
+                structure=Product.STANDALONE,
+                product_class=product_class,
+            )
+            children = self.create_children(parents, options["children"])
+
+            self.create_product_categories(parents + standalone_products, categories)
+            self.create_attribute_values(standalone_products + children, attributes)
+            self.create_stockrecords(
+                standalone_products + children, options["stockrecords"]
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Generated %i products (%i parents with %i children), %i categories "
+                "and %i attributes"
+                % (
+                    len(parents) + len(standalone_products) + len(children),
+                    len(parents),
+                    len(children),
+                    len(categories),
+                    len(attributes),
+                )
+            )
+        )
+
+    def create_attributes(self, product_class, num_attributes):
+        attributes = []
+        for i in range(num_attributes):
+            attribute, _ = ProductAttribute.objects.get_or_create(
+                product_class=product_class,
+                code="benchmark_%i" % i,
+                defaults={
+                    "name": "Benchmark %i" % i,
+                    "type": (
+                        ProductAttribute.INTEGER if i % 2 else ProductAttribute.TEXT
+                    ),
+                },
+            )
+            attributes.append(attribute)
+
+        return attributes
+
+    def create_categories(self, num_categories):
+        """
+        Create a two level category tree. The treebeard paths are generated here,
+        because adding the nodes one by one is slow and sends signals.
+        """
+        num_roots = max(1, num_categories // 10)
+        last_root = Category.get_last_root_node()
+        first_position = last_root._get_lastpos_in_path() + 1 if last_root else 1
+
+        roots = [
+            self.make_category(Category._get_path(None, 1, first_position + i), 1)
+            for i in range(min(num_roots, num_categories))
+        ]
+        children = []
+        for i in range(num_categories - len(roots)):
+            root = roots[i % len(roots)]
+            root.numchild += 1
+            children.append(
+                self.make_category(Category._get_path(root.path, 2, root.numchild), 2)
+            )
+
+        return Category.objects.bulk_create(roots + children, batch_size=BATCH_SIZE)
+
+    def make_category(self, path, depth):
+        name = "%s %s" % (self.random.choice(WORDS).title(), path)
+        return Category(name=name, slug=slugify(name), path=path, depth=depth)
+
+    def create_products(self, num_products, **kwargs):
+        products = []
+        for _ in range(num_products):
+            title = " ".join(self.random.sample(WORDS, 3)).capitalize()
+            products.append(
+                Product(title=title, slug=slugify(title), upc=self.make_upc(), **kwargs)
+            )
+
+        return Product.objects.bulk_create(products, batch_size=BATCH_SIZE)
+
+    def create_children(self, parents, num_children):
+        children = [
+            Product(
+                structure=Product.CHILD,
+                parent=parent,
+                title="%s %i" % (parent.title, i),
+                slug="%s-%i" % (parent.slug, i),
+                upc=self.make_upc(),
+            )
+            for parent in parents
+            for i in range(num_children)
+        ]
+        return Product.objects.bulk_create(children, batch_size=BATCH_SIZE)
+
+    def make_upc(self):
+        return "bench-%s-%s" % (self.run_id, get_random_string(12).lower())
+
+    def create_product_categories(self, products, categories):
+        if not categories:
+            return
+
+        ProductCategory.objects.bulk_create(
+            [
+                ProductCategory(product=product, category=category)
+                for product in products
+                for category in self.random.sample(categories, min(2, len(categories)))
+            ],
+            batch_size=BATCH_SIZE,
+        )
+
+    def create_attribute_values(self, products, attributes):
+        values = []
+        for product in products:
+            for attribute in attributes:
+                if attribute.type == ProductAttribute.INTEGER:
+                    value = {"value_integer": self.random.randint(1, 100)}
+                else:
+                    value = {"value_text": self.random.choice(WORDS)}
+                values.append(
+                    ProductAttributeValue(product=product, attribute=attribute, **value)
+                )
+
+        ProductAttributeValue.objects.bulk_create(values, batch_size=BATCH_SIZE)
+
+    def create_stockrecords(self, products, num_stockrecords):
+        partners = [
+            Partner.objects.get_or_create(name="Benchmark %i" % i)[0]
+            for i in range(num_stockrecords)
+        ]
+        StockRecord.objects.bulk_create(
+            [
+                StockRecord(
+                    product=product,
+                    partner=partner,
+                    partner_sku="%s-%i" % (self.run_id, product.pk),
+                    price=Decimal(self.random.randint(100, 10000)) / 100,
+                    num_in_stock=self.random.randint(0, 50),
+                )
+                for product in products
+                for partner in partners
+            ],
+            batch_size=BATCH_SIZE,
+        )
@@ -67,7 +67,8 @@ INSTALLED_APPS = [
     'django_tables2',
     'oscar_elasticsearch.search.apps.OscarElasticSearchConfig',
     "oscar_odin.apps.OscarOdinAppConfig",
-    "assortment"
+    "assortment",
+    "benchmark",
 ]
 
 MIDDLEWARE = [